@@ -1,39 +1,118 @@
+import argparse
 import asyncio
 import logging
+import os
+import sys
 
-from aiogram import Bot
-from sqlalchemy.ext.asyncio import AsyncSession
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
 
-from config import dp, bot, CHAT_ID
-from db.models import DatabaseMiddleware, create_tables, async_session
+from config import bot, WEBHOOK_ENABLED, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_URL, \
+    SCHEDULER_SHARDS, METRICS_HOST, METRICS_PORT
+from db.migrations import migrate
+from db.models import DatabaseMiddleware
+from db.storage import create_storage
 from handlers import start, creating_mailings, editing_mailings
-from misc.utils import start_mailing_scheduler
+from misc.logger import logger, setup_logging
+from misc.metrics import ApiMetricsMiddleware, start_metrics_server
+from misc.scheduler import start_mailing_scheduler
 
-logging.getLogger('aiogram').setLevel(logging.INFO)
+storage, events_isolation = create_storage()
+dp = Dispatcher(storage=storage, events_isolation=events_isolation)
+shard_processes: list[asyncio.subprocess.Process] = []
 
-PINK = "\033[38;5;219m"
-RESET = "\033[0m"
+
+async def start_metrics(port: int):
+    bot.session.middleware(ApiMetricsMiddleware())
+    if METRICS_PORT:
+        await start_metrics_server(METRICS_HOST, port)
+        logger.info('Метрики доступны', extra={'url': f'http://{METRICS_HOST}:{port}/metrics'})
 
 
 async def main():
-    await create_tables()
+    await start_metrics(METRICS_PORT)
+    await migrate()
+
+    routers = (start.router, creating_mailings.router, editing_mailings.router)
+    for router in routers:
+        router.message.middleware(DatabaseMiddleware())
+        router.callback_query.middleware(DatabaseMiddleware())
+
+    dp.include_routers(*routers)
 
-    dp.update.middleware(DatabaseMiddleware())
+    if WEBHOOK_ENABLED:
+        return await start_webhook()
 
-    dp.include_routers(start.router, creating_mailings.router, editing_mailings.router)
     await bot.delete_webhook(drop_pending_updates=True)
-    print(f'{PINK}Запущено!{RESET}')
+    logger.info('Запущено!', extra={'mode': 'polling'})
     await dp.start_polling(bot)
 
 
+async def start_webhook():
+    app = web.Application()
+    SimpleRequestHandler(dispatcher=dp, bot=bot, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+    setup_application(app, dp, bot=bot)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+    if WEBHOOK_URL:
+        await bot.set_webhook(f'{WEBHOOK_URL.rstrip("/")}{WEBHOOK_PATH}', secret_token=WEBHOOK_SECRET,
+                              drop_pending_updates=True)
+
+    logger.info('Запущено!', extra={'mode': 'webhook', 'url': f'http://{WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}'})
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+async def start_shard(shard: int, shards: int):
+    await start_metrics(METRICS_PORT + 1 + shard)
+    await start_mailing_scheduler(bot, shard, shards)
+    logger.info('Запущен планировщик', extra={'shard': shard, 'shards': shards})
+    await asyncio.Event().wait()
+
+
 async def on_startup(bot: Bot):
-    async with async_session() as session:
-        await start_mailing_scheduler(bot, session, CHAT_ID)
+    if SCHEDULER_SHARDS == 1:
+        return await start_mailing_scheduler(bot)
+
+    for shard in range(SCHEDULER_SHARDS):
+        shard_processes.append(await asyncio.create_subprocess_exec(
+            sys.executable, os.path.abspath(__file__), '--shard', f'{shard}/{SCHEDULER_SHARDS}'
+        ))
+
+
+async def on_shutdown():
+    for process in shard_processes:
+        if process.returncode is None:
+            process.terminate()
+
+
+def parse_shard(value: str) -> tuple[int, int]:
+    shard, shards = map(int, value.split('/'))
+    if not 0 <= shard < shards:
+        raise argparse.ArgumentTypeError('Номер шарда должен быть от 0 до K-1')
+    return shard, shards
 
 
 if __name__ == '__main__':
+    setup_logging()
+    logging.getLogger('aiogram').setLevel(logging.INFO)
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--shard', type=parse_shard, help='запустить только планировщик для рассылок с id %% K == i, формат i/K')
+    args = parser.parse_args()
+
     try:
-        dp.startup.register(on_startup)
-        asyncio.run(main())
+        if args.shard:
+            asyncio.run(start_shard(*args.shard))
+        else:
+            dp.startup.register(on_startup)
+            dp.shutdown.register(on_shutdown)
+            asyncio.run(main())
     except (KeyboardInterrupt, RuntimeError) as main_error:
-        print('Бот выключен.')
+        logger.info('Бот выключен.')
@@ -0,0 +1,74 @@
+import asyncio
+import json
+import random
+import time
+from collections import Counter
+
+from aiohttp import web
+
+BOT_ID = 1000000
+
+
+class FakeBotApi:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.01, rate_429: float = 0.0, retry_after: int = 1,
+                 error_rate: float = 0.0):
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_429 = rate_429
+        self.retry_after = retry_after
+        self.error_rate = error_rate
+        self.calls: Counter[str] = Counter()
+        self.errors: Counter[int] = Counter()
+        self._message_id = 0
+
+    def _message(self, data) -> dict:
+        self._message_id += 1
+        return {
+            'message_id': self._message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(data.get('chat_id', 0)), 'type': 'supergroup'},
+            'text': data.get('text') or data.get('caption') or '',
+        }
+
+    def _result(self, method: str, data):
+        if method == 'getMe':
+            return {'id': BOT_ID, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+        if method == 'sendMediaGroup':
+            return [self._message(data) for _ in json.loads(data['media'])]
+        if method.startswith('send') or method.startswith('edit'):
+            return self._message(data)
+
+        return True
+
+    def _error(self, code: int, description: str, **parameters) -> web.Response:
+        self.errors[code] += 1
+        body = {'ok': False, 'error_code': code, 'description': description}
+        if parameters:
+            body['parameters'] = parameters
+
+        return web.json_response(body, status=code)
+
+    async def handle(self, request: web.Request) -> web.Response:
+        method = request.match_info['method']
+        self.calls[method] += 1
+        data = await request.post()
+
+        await asyncio.sleep(max(random.gauss(self.latency, self.jitter), 0))
+
+        roll = random.random()
+        if roll < self.rate_429:
+            return self._error(429, f'Too Many Requests: retry after {self.retry_after}', retry_after=self.retry_after)
+        if roll < self.rate_429 + self.error_rate:
+            return self._error(500, 'Internal Server Error')
+
+        return web.json_response({'ok': True, 'result': self._result(method, data)})
+
+    async def start(self, host: str, port: int) -> web.AppRunner:
+        app = web.Application()
+        app.router.add_post('/{token}/{method}', self.handle)
+
+        runner = web.AppRunner(app)
+        await runner.setup()
+        await web.TCPSite(runner, host, port).start()
+
+        return runner
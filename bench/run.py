@@ -0,0 +1,44 @@
+import argparse
+import json
+import subprocess
+import sys
+
+COLUMNS = (
+    ('mailings', 'рассылок', '{:.0f}'),
+    ('seed_seconds', 'сид, с', '{:.1f}'),
+    ('throughput', 'отправок/с', '{:.1f}'),
+    ('api_calls_per_second', 'API/с', '{:.1f}'),
+    ('lag_p50', 'лаг p50, с', '{:.3f}'),
+    ('lag_p99', 'лаг p99, с', '{:.3f}'),
+    ('queries_per_tick', 'запросов/тик', '{:.1f}'),
+    ('tick_p99', 'тик p99, с', '{:.3f}'),
+    ('admin_p50', 'админка p50, с', '{:.3f}'),
+    ('admin_p99', 'админка p99, с', '{:.3f}'),
+)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Бенчмарк планировщика и админки на фейковом Bot API',
+                                     epilog='Остальные параметры передаются в bench.scenario как есть.')
+    parser.add_argument('--sizes', default='10,1000,100000', help='числа рассылок через запятую')
+    parser.add_argument('--json', action='store_true', help='вывести результаты в JSON')
+    args, scenario_args = parser.parse_known_args()
+
+    results = []
+    for size in map(int, args.sizes.split(',')):
+        output = subprocess.run(
+            [sys.executable, '-m', 'bench.scenario', '--mailings', str(size), *scenario_args],
+            check=True, stdout=subprocess.PIPE, text=True
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+
+    if args.json:
+        return print(json.dumps(results, ensure_ascii=False, indent=2))
+
+    print(' | '.join(title for _, title, _ in COLUMNS))
+    for result in results:
+        print(' | '.join(fmt.format(result.get(key, 0)) for key, _, fmt in COLUMNS))
+
+
+if __name__ == '__main__':
+    main()
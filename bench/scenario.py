@@ -0,0 +1,227 @@
+import argparse
+import asyncio
+import json
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from bench.fake_api import FakeBotApi
+
+BENCH_TOKEN = '1000000:bench'
+ADMIN_ID = 1
+FIRST_CHAT_ID = -1001000000000
+SEED_CHUNK = 5000
+ADMIN_SCENARIO = ('admin', 'page', 'card', 'back')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Один прогон бенчмарка на заданном числе рассылок')
+    parser.add_argument('--database-url', help='БД для прогона, все таблицы в ней будут пересозданы '
+                                                 '(по умолчанию временный файл SQLite)')
+    parser.add_argument('--mailings', type=int, default=1000)
+    parser.add_argument('--chats', type=int, default=100, help='сколько разных чатов получают рассылки')
+    parser.add_argument('--targets', type=int, default=1, help='чатов на одну рассылку')
+    parser.add_argument('--period', type=int, default=60, help='периодичность рассылок в секундах, не меньше 60')
+    parser.add_argument('--send-mode', default='replace', choices=('replace', 'edit', 'send_then_delete'))
+    parser.add_argument('--duration', type=float, default=60, help='длительность замера планировщика в секундах')
+    parser.add_argument('--admin-requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.05, help='средняя задержка фейкового Bot API в секундах')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--rate-429', type=float, default=0.0, help='доля ответов 429')
+    parser.add_argument('--retry-after', type=int, default=1)
+    parser.add_argument('--error-rate', type=float, default=0.0, help='доля ответов 500')
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--global-rate', type=float, default=1000)
+    parser.add_argument('--chat-rate', type=float, default=1000, help='лимит отправок в один чат в секунду')
+    parser.add_argument('--api-port', type=int, default=8099)
+
+    return parser.parse_args()
+
+
+def configure(args):
+    if not args.database_url:
+        args.database_url = f'sqlite+aiosqlite:///{tempfile.mkdtemp()}/bench.db'
+
+    os.environ.update({
+        'TOKEN': BENCH_TOKEN,
+        'ADMIN_IDS': str(ADMIN_ID),
+        'CHAT_ID': str(FIRST_CHAT_ID),
+        'CHAT_IDS': str(FIRST_CHAT_ID),
+        'DATABASE_URL': args.database_url,
+        'TELEGRAM_API_URL': f'http://127.0.0.1:{args.api_port}',
+        'SEND_WORKERS': str(args.workers),
+        'GLOBAL_RATE_LIMIT': str(args.global_rate),
+        'CHAT_RATE_LIMIT': str(args.chat_rate),
+        'CHAT_RATE_PERIOD': '1',
+        'SCHEDULER_SHARDS': '1',
+        'METRICS_PORT': '0',
+        'LOG_LEVEL': 'ERROR',
+        'FSM_STORAGE': 'memory',
+    })
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+
+    values = sorted(values)
+    return values[min(int(q * len(values)), len(values) - 1)]
+
+
+async def reset_database():
+    from db.migrations import migrate
+    from db.models import Base, engine
+
+    async with engine.begin() as conn:
+        await conn.run_sync(Base.metadata.drop_all)
+    await migrate()
+
+
+async def seed(args) -> list[int]:
+    from sqlalchemy import insert
+    from config import MSK
+    from db.models import Mailings, Buttons, MailingTargets, session_scope
+
+    now = datetime.now(MSK)
+    chat_ids = [FIRST_CHAT_ID - i for i in range(args.chats)]
+    mailing_ids = []
+
+    for start in range(0, args.mailings, SEED_CHUNK):
+        rows = [
+            {
+                'text': f'Бенчмарк #{i}', 'per': f'{args.period // 60}m', 'globalper': '1M', 'status': True,
+                'expires_at': now + timedelta(days=30),
+                'next_due_at': now + timedelta(seconds=random.uniform(0, args.period)),
+                'send_mode': args.send_mode,
+            }
+            for i in range(start, min(start + SEED_CHUNK, args.mailings))
+        ]
+
+        async with session_scope() as session:
+            ids = (await session.scalars(insert(Mailings).returning(Mailings.id), rows)).all()
+            await session.execute(insert(Buttons), [
+                {'mailing_id': mailing_id, 'text': 'Ссылка', 'url': 'https://example.com'} for mailing_id in ids
+            ])
+            await session.execute(insert(MailingTargets), [
+                {'mailing_id': mailing_id, 'chat_id': chat_id}
+                for mailing_id in ids for chat_id in random.sample(chat_ids, min(args.targets, len(chat_ids)))
+            ])
+            await session.commit()
+
+        mailing_ids += ids
+
+    return mailing_ids
+
+
+async def bench_scheduler(args, bot, api: FakeBotApi) -> dict:
+    from misc.metrics import registry, SENDS, SEND_LAG, TICK_DURATION, DB_QUERY
+    from misc.scheduler import scheduler, start_mailing_scheduler
+
+    for metric in registry:
+        metric.reset()
+    api.calls.clear()
+
+    started = time.perf_counter()
+    await start_mailing_scheduler(bot)
+    await asyncio.sleep(args.duration)
+    await scheduler.stop()
+    elapsed = time.perf_counter() - started
+
+    sent = SENDS.value('sent') + SENDS.value('edited') + SENDS.value('unchanged')
+    ticks = TICK_DURATION.count()
+
+    return {
+        'sends': sent,
+        'failed': SENDS.value('failed'),
+        'throughput': sent / elapsed,
+        'api_calls_per_second': sum(api.calls.values()) / elapsed,
+        'lag_p50': SEND_LAG.quantile(0.5),
+        'lag_p99': SEND_LAG.quantile(0.99),
+        'ticks': ticks,
+        'queries_per_tick': DB_QUERY.count() / ticks if ticks else 0.0,
+        'tick_p99': TICK_DURATION.quantile(0.99),
+    }
+
+
+def admin_updates(mailing_ids: list[int], count: int):
+    from aiogram.types import Update, Message, CallbackQuery, Chat, User
+
+    user = User(id=ADMIN_ID, is_bot=False, first_name='Admin')
+    chat = Chat(id=ADMIN_ID, type='private')
+    message = Message(message_id=1, date=datetime.now(), chat=chat, from_user=user, text='/admin')
+
+    for i in range(count):
+        name = ADMIN_SCENARIO[i % len(ADMIN_SCENARIO)]
+        if name == 'admin':
+            yield name, Update(update_id=i, message=message)
+            continue
+
+        mailing_id = random.choice(mailing_ids)
+        data = {'page': f'mailings_after_{mailing_id}', 'card': f'mailing_{mailing_id}', 'back': 'back_to_mailings'}[name]
+        yield name, Update(update_id=i, callback_query=CallbackQuery(
+            id=str(i), from_user=user, chat_instance='bench', data=data, message=message
+        ))
+
+
+async def bench_admin(args, bot, mailing_ids: list[int]) -> dict:
+    from aiogram import Dispatcher
+    from aiogram.fsm.storage.memory import MemoryStorage
+    from db.models import DatabaseMiddleware
+    from handlers import start, creating_mailings, editing_mailings
+
+    dp = Dispatcher(storage=MemoryStorage())
+    routers = (start.router, creating_mailings.router, editing_mailings.router)
+    for router in routers:
+        router.message.middleware(DatabaseMiddleware())
+        router.callback_query.middleware(DatabaseMiddleware())
+    dp.include_routers(*routers)
+
+    timings: dict[str, list[float]] = {}
+    errors = 0
+    for name, update in admin_updates(mailing_ids, args.admin_requests):
+        started = time.perf_counter()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception:
+            errors += 1
+        timings.setdefault(name, []).append(time.perf_counter() - started)
+
+    everything = [value for values in timings.values() for value in values]
+    return {
+        'admin_p50': percentile(everything, 0.5),
+        'admin_p99': percentile(everything, 0.99),
+        'admin_errors': errors,
+        **{f'admin_{name}_p50': percentile(values, 0.5) for name, values in timings.items()},
+    }
+
+
+async def main(args):
+    api = FakeBotApi(args.latency, args.jitter, args.rate_429, args.retry_after, args.error_rate)
+    runner = await api.start('127.0.0.1', args.api_port)
+
+    configure(args)
+    from config import bot
+    from misc.logger import setup_logging
+    setup_logging()
+
+    try:
+        await reset_database()
+
+        started = time.perf_counter()
+        mailing_ids = await seed(args)
+        result = {'mailings': args.mailings, 'seed_seconds': time.perf_counter() - started}
+
+        result.update(await bench_scheduler(args, bot, api))
+        result.update(await bench_admin(args, bot, mailing_ids))
+        result['api_errors'] = dict(api.errors)
+    finally:
+        await bot.session.close()
+        await runner.cleanup()
+
+    print(json.dumps(result, ensure_ascii=False))
+
+
+if __name__ == '__main__':
+    asyncio.run(main(parse_args()))
@@ -1,6 +1,7 @@
 import pytz
-from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram import Bot
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from environs import Env
 
 MSK = pytz.timezone("Europe/Moscow")
@@ -9,7 +10,42 @@ env = Env()
 env.read_env('.env')
 
 TOKEN = env.str('TOKEN')
-CHAT_ID = env.int('CHAT_ID')
+CHAT_ID = env.int('CHAT_ID', None)
+CHAT_IDS = env.list('CHAT_IDS', [CHAT_ID] if CHAT_ID else [], subcast=int)
 ADMIN_IDS = env.list('ADMIN_IDS')
-bot = Bot(token=TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
\ No newline at end of file
+TELEGRAM_API_URL = env.str('TELEGRAM_API_URL', None)
+
+SEND_WORKERS = env.int('SEND_WORKERS', 8)
+GLOBAL_RATE_LIMIT = env.float('GLOBAL_RATE_LIMIT', 30)
+CHAT_RATE_LIMIT = env.float('CHAT_RATE_LIMIT', 20)
+CHAT_RATE_PERIOD = env.float('CHAT_RATE_PERIOD', 60)
+SEND_MAX_ATTEMPTS = env.int('SEND_MAX_ATTEMPTS', 5)
+PAYLOAD_CACHE_SIZE = env.int('PAYLOAD_CACHE_SIZE', 1024)
+MAILING_CACHE_TTL = env.float('MAILING_CACHE_TTL', 30)
+
+SCHEDULER_RESYNC = env.float('SCHEDULER_RESYNC', 5)
+SCHEDULER_HEARTBEAT = env.float('SCHEDULER_HEARTBEAT', 30)
+SCHEDULER_CLAIM_BATCH = env.int('SCHEDULER_CLAIM_BATCH', 500)
+SCHEDULER_SHARDS = env.int('SCHEDULER_SHARDS', 1)
+
+CLEANUP_INTERVAL = env.float('CLEANUP_INTERVAL', 60)
+CLEANUP_BATCH = env.int('CLEANUP_BATCH', 1000)
+
+WEBHOOK_ENABLED = env.bool('WEBHOOK_ENABLED', False)
+WEBHOOK_HOST = env.str('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = env.int('WEBHOOK_PORT', 8080)
+WEBHOOK_PATH = env.str('WEBHOOK_PATH', '/webhook')
+WEBHOOK_SECRET = env.str('WEBHOOK_SECRET', None)
+WEBHOOK_URL = env.str('WEBHOOK_URL', None)
+
+FSM_STORAGE = env.str('FSM_STORAGE', 'memory')
+FSM_TTL = env.int('FSM_TTL', 86400)
+REDIS_URL = env.str('REDIS_URL', 'redis://127.0.0.1:6379/0')
+
+LOG_LEVEL = env.str('LOG_LEVEL', 'INFO')
+LOG_FORMAT = env.str('LOG_FORMAT', 'json')
+METRICS_HOST = env.str('METRICS_HOST', '127.0.0.1')
+METRICS_PORT = env.int('METRICS_PORT', 0)
+
+bot = Bot(token=TOKEN, session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+          if TELEGRAM_API_URL else None)
\ No newline at end of file
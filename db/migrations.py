@@ -0,0 +1,184 @@
+from datetime import datetime
+from typing import Awaitable, Callable, NamedTuple
+
+from sqlalchemy import BigInteger, Column, inspect, insert, select, literal, text
+from sqlalchemy.ext.asyncio import AsyncConnection
+
+from config import MSK, CHAT_ID
+from db.models import Base, Mailings, MailingTargets, SchedulerShards, SchemaVersion, engine, IS_SQLITE
+from misc.logger import logger
+
+MIGRATIONS_LOCK = 7283001
+
+
+class Migration(NamedTuple):
+    version: int
+    description: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+    concurrent: bool
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str, concurrent: bool = False):
+    def decorator(func: Callable[[AsyncConnection], Awaitable[None]]):
+        MIGRATIONS.append(Migration(version, description, func, concurrent))
+        return func
+
+    return decorator
+
+
+async def table_columns(conn: AsyncConnection, table: str) -> set[str]:
+    return await conn.run_sync(lambda sync_conn: {c['name'] for c in inspect(sync_conn).get_columns(table)})
+
+
+async def add_column(conn: AsyncConnection, column: Column):
+    table = column.table.name
+    if column.name in await table_columns(conn, table):
+        return
+
+    ddl = f'ALTER TABLE {table} ADD COLUMN {column.name} {column.type.compile(dialect=conn.dialect)}'
+    if column.server_default is not None:
+        ddl += f" DEFAULT '{column.server_default.arg}'"
+    if not column.nullable:
+        ddl += ' NOT NULL'
+
+    await conn.execute(text(ddl))
+
+
+async def drop_column(conn: AsyncConnection, table: str, name: str):
+    if name in await table_columns(conn, table):
+        await conn.execute(text(f'ALTER TABLE {table} DROP COLUMN {name}'))
+
+
+async def create_index(conn: AsyncConnection, name: str, definition: str, concurrently: bool = False):
+    concurrently = 'CONCURRENTLY ' if concurrently and not IS_SQLITE else ''
+    await conn.execute(text(f'CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {definition}'))
+
+
+@migration(1, 'Расписание и версии рассылок')
+async def schedule_columns(conn: AsyncConnection):
+    columns = Mailings.__table__.c
+    for column in (columns.expires_at, columns.next_due_at, columns.version):
+        await add_column(conn, column)
+
+    await create_index(conn, 'ix_mailings_next_due_at', 'mailings (next_due_at) WHERE status')
+
+
+@migration(2, 'Тип медиа, альбомы и режим отправки')
+async def media_columns(conn: AsyncConnection):
+    columns = Mailings.__table__.c
+    for column in (columns.media_type, columns.send_mode, MailingTargets.__table__.c.extra_message_ids):
+        await add_column(conn, column)
+
+    await conn.execute(text(
+        "UPDATE mailings SET media_type = CASE "
+        "WHEN media LIKE 'AgAC%' THEN 'photo' "
+        "WHEN media LIKE 'BAAC%' THEN 'video' "
+        "WHEN media LIKE 'CgAC%' THEN 'animation' "
+        "WHEN media LIKE 'BQAC%' THEN 'document' "
+        "END "
+        "WHERE media IS NOT NULL AND media_type IS NULL"
+    ))
+
+
+@migration(3, 'Индексы для выборок планировщика и кнопок', concurrent=True)
+async def hot_indexes(conn: AsyncConnection):
+    await create_index(conn, 'ix_buttons_mailing_id', 'buttons (mailing_id)', concurrently=True)
+    await create_index(conn, 'ix_mailings_status', 'mailings (status)', concurrently=True)
+    await create_index(conn, 'ix_mailings_expires_at', 'mailings (expires_at) WHERE status', concurrently=True)
+
+
+@migration(4, 'Тихие часы рассылок')
+async def quiet_hours_column(conn: AsyncConnection):
+    await add_column(conn, Mailings.__table__.c.quiet_hours)
+
+
+@migration(5, 'Пульс планировщика по идентификатору процесса')
+async def scheduler_process_ids(conn: AsyncConnection):
+    table = SchedulerShards.__table__
+    if 'process_id' in await table_columns(conn, table.name):
+        return
+
+    await conn.run_sync(lambda sync_conn: table.drop(sync_conn))
+    await conn.run_sync(lambda sync_conn: table.create(sync_conn))
+
+
+@migration(6, 'Удаление неиспользуемой колонки per_seconds')
+async def drop_per_seconds(conn: AsyncConnection):
+    await drop_column(conn, 'mailings', 'per_seconds')
+
+
+@migration(7, 'Чат CHAT_ID как получатель старых рассылок')
+async def chat_id_targets(conn: AsyncConnection):
+    if not CHAT_ID:
+        return
+
+    await conn.execute(
+        insert(MailingTargets).from_select(
+            ["mailing_id", "chat_id", "last_message_id"],
+            select(Mailings.id, literal(CHAT_ID, BigInteger), Mailings.last_message_id)
+            .where(~Mailings.targets.any())
+        )
+    )
+
+
+async def apply_migrations():
+    async with engine.connect() as conn:
+        applied = set((await conn.execute(select(SchemaVersion.version))).scalars().all())
+
+    for pending in sorted(MIGRATIONS, key=lambda item: item.version):
+        if pending.version in applied:
+            continue
+
+        record = insert(SchemaVersion).values(version=pending.version, description=pending.description,
+                                              applied_at=datetime.now(MSK))
+        if pending.concurrent:
+            async with engine.connect() as conn:
+                conn = await conn.execution_options(isolation_level='AUTOCOMMIT')
+                await pending.apply(conn)
+                await conn.execute(record)
+        else:
+            async with engine.begin() as conn:
+                await pending.apply(conn)
+                await conn.execute(record)
+
+        logger.info('Применена миграция', extra={'version': pending.version, 'description': pending.description})
+
+
+async def find_missing_indexes(conn: AsyncConnection) -> list[str]:
+    def missing(sync_conn) -> list[str]:
+        inspector = inspect(sync_conn)
+        names = []
+        for table in Base.metadata.sorted_tables:
+            present = {index['name'] for index in inspector.get_indexes(table.name)}
+            names += [index.name for index in table.indexes if index.name not in present]
+        return names
+
+    names = await conn.run_sync(missing)
+    if not IS_SQLITE:
+        names += (await conn.execute(text(
+            "SELECT c.relname FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE NOT i.indisvalid"
+        ))).scalars().all()
+
+    return names
+
+
+async def migrate():
+    async with engine.connect() as lock:
+        lock = await lock.execution_options(isolation_level='AUTOCOMMIT')
+        if not IS_SQLITE:
+            await lock.execute(text('SELECT pg_advisory_lock(:key)'), {'key': MIGRATIONS_LOCK})
+        try:
+            async with engine.begin() as conn:
+                await conn.run_sync(Base.metadata.create_all)
+
+            await apply_migrations()
+        finally:
+            if not IS_SQLITE:
+                await lock.execute(text('SELECT pg_advisory_unlock(:key)'), {'key': MIGRATIONS_LOCK})
+
+    async with engine.begin() as conn:
+        for name in await find_missing_indexes(conn):
+            logger.warning('Отсутствует или повреждён индекс', extra={'index': name})
@@ -1,51 +1,237 @@
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timezone
 
 import pytz
 from aiogram import BaseMiddleware
 from aiogram.types import TelegramObject
-from sqlalchemy import Column, BigInteger, Text, ForeignKey, Boolean, DateTime
+from sqlalchemy import event, Column, BigInteger, Integer, Text, ForeignKey, Boolean, DateTime, UniqueConstraint, Index, JSON, text, TypeDecorator
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, async_sessionmaker
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relationship
 
-from config import MSK
+from config import env, MSK
+from misc.metrics import DB_QUERY, DB_POOL
 
-DATABASE_URL = "postgresql+asyncpg://postgres:Пароль от БД@127.0.0.1:5432/Имя БД"
-engine = create_async_engine(DATABASE_URL, echo=False)
+DATABASE_URL = env.str("DATABASE_URL", "postgresql+asyncpg://postgres:Пароль от БД@127.0.0.1:5432/Имя БД")
+IS_SQLITE = DATABASE_URL.startswith("sqlite")
+
+if IS_SQLITE:
+    engine = create_async_engine(DATABASE_URL, echo=False)
+else:
+    engine = create_async_engine(
+        DATABASE_URL,
+        echo=False,
+        pool_size=env.int('DB_POOL_SIZE', 10),
+        max_overflow=env.int('DB_MAX_OVERFLOW', 10),
+        pool_timeout=env.float('DB_POOL_TIMEOUT', 30),
+        pool_recycle=env.int('DB_POOL_RECYCLE', 1800),
+        pool_pre_ping=env.bool('DB_POOL_PRE_PING', True),
+    )
 
 Base = declarative_base()
+BigId = BigInteger().with_variant(Integer, "sqlite")
 async_session = async_sessionmaker(engine, class_=AsyncSession, expire_on_commit=False)
 
 
+class AwareDateTime(TypeDecorator):
+    impl = DateTime(timezone=True)
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        if value is not None and dialect.name == "sqlite":
+            return value.astimezone(timezone.utc).replace(tzinfo=None)
+        return value
+
+    def process_result_value(self, value, dialect):
+        if value is not None and value.tzinfo is None:
+            return value.replace(tzinfo=timezone.utc)
+        return value
+
+
+def upsert(model):
+    return (sqlite.insert if IS_SQLITE else postgresql.insert)(model)
+
+
+class PoolStats:
+    def __init__(self):
+        self.checkouts = 0
+        self.connects = 0
+        self.invalidations = 0
+        self.waits = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def record_wait(self, seconds: float):
+        self.waits += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def snapshot(self) -> dict:
+        pool = engine.sync_engine.pool
+        sizes = {}
+        if hasattr(pool, 'size'):
+            sizes = {
+                'size': pool.size(),
+                'checked_out': pool.checkedout(),
+                'checked_in': pool.checkedin(),
+                'overflow': pool.overflow(),
+            }
+
+        return {
+            **sizes,
+            'checkouts': self.checkouts,
+            'connects': self.connects,
+            'invalidations': self.invalidations,
+            'wait_avg': self.wait_total / self.waits if self.waits else 0.0,
+            'wait_max': self.wait_max,
+        }
+
+
+pool_stats = PoolStats()
+DB_POOL.set_function(lambda: {(key,): value for key, value in pool_stats.snapshot().items()})
+
+
+@event.listens_for(engine.sync_engine, 'checkout')
+def on_checkout(dbapi_connection, connection_record, connection_proxy):
+    pool_stats.checkouts += 1
+
+
+@event.listens_for(engine.sync_engine, 'connect')
+def on_connect(dbapi_connection, connection_record):
+    pool_stats.connects += 1
+
+
+if IS_SQLITE:
+    @event.listens_for(engine.sync_engine, 'connect')
+    def on_sqlite_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.execute('PRAGMA busy_timeout=5000')
+        cursor.close()
+
+
+@event.listens_for(engine.sync_engine, 'invalidate')
+def on_invalidate(dbapi_connection, connection_record, exception):
+    pool_stats.invalidations += 1
+
+
+@event.listens_for(engine.sync_engine, 'before_cursor_execute')
+def on_before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+
+@event.listens_for(engine.sync_engine, 'after_cursor_execute')
+def on_after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    DB_QUERY.observe(time.perf_counter() - context.query_started)
+
+
+@asynccontextmanager
+async def session_scope():
+    async with async_session() as session:
+        started = time.monotonic()
+        await session.connection()
+        pool_stats.record_wait(time.monotonic() - started)
+        yield session
+
+
+class LazySession:
+    def __init__(self, session_factory: async_sessionmaker):
+        self._session_factory = session_factory
+        self._session: AsyncSession | None = None
+
+    def __getattr__(self, name: str):
+        if self._session is None:
+            self._session = self._session_factory()
+        return getattr(self._session, name)
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+
 class DatabaseMiddleware(BaseMiddleware):
     async def __call__(self, handler, event: TelegramObject, dict: dict):
-        async with async_session() as session:
-            dict["session"] = session
+        session = LazySession(async_session)
+        dict["session"] = session
+        try:
             return await handler(event, dict)
+        finally:
+            await session.close()
 
 
 class Mailings(Base):
     __tablename__ = "mailings"
-    id = Column(BigInteger, primary_key=True)
+    __table_args__ = (Index("ix_mailings_next_due_at", "next_due_at", postgresql_where=text("status"),
+                            sqlite_where=text("status")),
+                      Index("ix_mailings_expires_at", "expires_at", postgresql_where=text("status"),
+                            sqlite_where=text("status")))
+    id = Column(BigId, primary_key=True)
     text = Column(Text)
     media = Column(Text)
+    media_type = Column(Text, nullable=True)
+    send_mode = Column(Text, nullable=False, default='replace', server_default='replace')
     per = Column(Text)
     globalper = Column(Text)
-    status = Column(Boolean, default=True)
-    created_at = Column(DateTime(timezone=True), default=datetime.now(MSK))
-    last_sent = Column(DateTime(timezone=True), nullable=True)
+    status = Column(Boolean, default=True, index=True)
+    created_at = Column(AwareDateTime, default=lambda: datetime.now(MSK))
+    last_sent = Column(AwareDateTime, nullable=True)
     last_message_id = Column(BigInteger, nullable=True)
+    quiet_hours = Column(Text, nullable=True)
+    expires_at = Column(AwareDateTime, nullable=True)
+    next_due_at = Column(AwareDateTime, nullable=True)
+    version = Column(Integer, nullable=False, default=1, server_default="1")
 
-    buttons = relationship("Buttons", backref="mailing", cascade="all, delete-orphan")
+    buttons = relationship("Buttons", backref="mailing", cascade="all, delete-orphan", order_by="Buttons.id")
+    targets = relationship("MailingTargets", backref="mailing", cascade="all, delete-orphan")
 
 class Buttons(Base):
     __tablename__ = "buttons"
-    id = Column(BigInteger, primary_key=True)
-    mailing_id = Column(BigInteger, ForeignKey("mailings.id"), nullable=False)
+    id = Column(BigId, primary_key=True)
+    mailing_id = Column(BigInteger, ForeignKey("mailings.id"), nullable=False, index=True)
     text = Column(Text)
     url = Column(Text)
 
+class MailingTargets(Base):
+    __tablename__ = "mailing_targets"
+    __table_args__ = (UniqueConstraint("mailing_id", "chat_id"),)
+    id = Column(BigId, primary_key=True)
+    mailing_id = Column(BigInteger, ForeignKey("mailings.id"), nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    last_message_id = Column(BigInteger, nullable=True)
+    extra_message_ids = Column(JSON, nullable=True)
+
+class SentMessages(Base):
+    __tablename__ = "sent_messages"
+    __table_args__ = (Index("ix_sent_messages_mailing_chat", "mailing_id", "chat_id"),
+                      Index("ix_sent_messages_stale", "chat_id", postgresql_where=text("stale"),
+                            sqlite_where=text("stale")))
+    id = Column(BigId, primary_key=True)
+    mailing_id = Column(BigInteger, nullable=False)
+    chat_id = Column(BigInteger, nullable=False)
+    message_id = Column(BigInteger, nullable=False)
+    sent_at = Column(AwareDateTime, nullable=False)
+    stale = Column(Boolean, nullable=False, default=False)
+
+class SchedulerShards(Base):
+    __tablename__ = "scheduler_shards"
+    process_id = Column(Text, primary_key=True)
+    shard = Column(Integer, nullable=False)
+    shards = Column(Integer, nullable=False)
+    heartbeat_at = Column(AwareDateTime, nullable=False)
+
+class FsmStates(Base):
+    __tablename__ = "fsm_states"
+    key = Column(Text, primary_key=True)
+    state = Column(Text, nullable=True)
+    data = Column(JSON, nullable=True)
+    updated_at = Column(AwareDateTime, nullable=False, index=True)
 
-async def create_tables():
-    async with engine.begin() as conn:
-        await conn.run_sync(Base.metadata.create_all)
+class SchemaVersion(Base):
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(Text, nullable=False)
+    applied_at = Column(AwareDateTime, nullable=False)
@@ -0,0 +1,185 @@
+import asyncio
+import hashlib
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
+from typing import Any, AsyncGenerator
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, BaseEventIsolation, StorageKey, StateType, DefaultKeyBuilder
+from aiogram.fsm.storage.memory import MemoryStorage, SimpleEventIsolation
+from sqlalchemy import select, delete, or_, and_, text
+
+from config import MSK, FSM_STORAGE, FSM_TTL, REDIS_URL
+from db.models import FsmStates, async_session, engine, upsert, IS_SQLITE
+from misc.logger import logger
+
+CLEANUP_INTERVAL = 3600
+
+
+class DatabaseStorage(BaseStorage):
+    def __init__(self, ttl: int = FSM_TTL):
+        self.ttl = ttl
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._cleanup_task: asyncio.Task | None = None
+
+    async def _upsert(self, key: StorageKey, **values):
+        self.start_cleanup()
+
+        now = datetime.now(MSK)
+        stmt = upsert(FsmStates).values(key=self.key_builder.build(key), updated_at=now, **values)
+        stmt = stmt.on_conflict_do_update(index_elements=[FsmStates.key], set_={**values, 'updated_at': now})
+
+        async with async_session() as session:
+            await session.execute(stmt)
+            await session.commit()
+
+    async def _get(self, key: StorageKey, column) -> Any:
+        async with async_session() as session:
+            return await session.scalar(select(column).where(FsmStates.key == self.key_builder.build(key)))
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._upsert(key, state=state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return await self._get(key, FsmStates.state)
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self._upsert(key, data=dict(data) or None)
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict(await self._get(key, FsmStates.data) or {})
+
+    async def cleanup(self):
+        async with async_session() as session:
+            await session.execute(delete(FsmStates).where(or_(
+                FsmStates.updated_at < datetime.now(MSK) - timedelta(seconds=self.ttl),
+                and_(FsmStates.state.is_(None), FsmStates.data.is_(None)),
+            )))
+            await session.commit()
+
+    async def _cleanup_loop(self):
+        while True:
+            try:
+                await self.cleanup()
+            except Exception as e:
+                logger.warning('Не удалось очистить состояния FSM', extra={'error': str(e)})
+            await asyncio.sleep(CLEANUP_INTERVAL)
+
+    def start_cleanup(self):
+        if self._cleanup_task is None:
+            self._cleanup_task = asyncio.create_task(self._cleanup_loop())
+
+    async def close(self) -> None:
+        if self._cleanup_task:
+            self._cleanup_task.cancel()
+
+
+class DatabaseEventIsolation(BaseEventIsolation):
+    def __init__(self):
+        self.key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._local = SimpleEventIsolation()
+
+    def _lock_id(self, key: StorageKey) -> int:
+        digest = hashlib.blake2b(self.key_builder.build(key).encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big', signed=True)
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        async with self._local.lock(key):
+            if IS_SQLITE:
+                yield
+                return
+
+            async with engine.begin() as conn:
+                await conn.execute(text('SELECT pg_advisory_xact_lock(:key)'), {'key': self._lock_id(key)})
+                yield
+
+    async def close(self) -> None:
+        await self._local.close()
+
+
+class CachedStorage(BaseStorage):
+    def __init__(self, storage: BaseStorage):
+        self.storage = storage
+        self._cache: dict[tuple[StorageKey, str], Any] = {}
+        self._scoped: dict[StorageKey, int] = {}
+
+    def enter(self, key: StorageKey):
+        self._scoped[key] = self._scoped.get(key, 0) + 1
+
+    def leave(self, key: StorageKey):
+        self._scoped[key] -= 1
+        if not self._scoped[key]:
+            del self._scoped[key]
+            self._cache.pop((key, 'state'), None)
+            self._cache.pop((key, 'data'), None)
+
+    def _get_cached(self, key: StorageKey, part: str) -> tuple[bool, Any]:
+        if (key, part) not in self._cache:
+            return False, None
+
+        return True, self._cache[(key, part)]
+
+    def _set_cached(self, key: StorageKey, part: str, value: Any):
+        if key in self._scoped:
+            self._cache[(key, part)] = value
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self.storage.set_state(key, state)
+        self._set_cached(key, 'state', state.state if isinstance(state, State) else state)
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        found, state = self._get_cached(key, 'state')
+        if not found:
+            state = await self.storage.get_state(key)
+            self._set_cached(key, 'state', state)
+
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        await self.storage.set_data(key, data)
+        self._set_cached(key, 'data', dict(data))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        found, data = self._get_cached(key, 'data')
+        if not found:
+            data = await self.storage.get_data(key)
+            self._set_cached(key, 'data', data)
+
+        return dict(data)
+
+    async def close(self) -> None:
+        await self.storage.close()
+
+
+class CacheScopeIsolation(BaseEventIsolation):
+    def __init__(self, isolation: BaseEventIsolation, storage: CachedStorage):
+        self.isolation = isolation
+        self.storage = storage
+
+    @asynccontextmanager
+    async def lock(self, key: StorageKey) -> AsyncGenerator[None, None]:
+        async with self.isolation.lock(key):
+            self.storage.enter(key)
+            try:
+                yield
+            finally:
+                self.storage.leave(key)
+
+    async def close(self) -> None:
+        await self.isolation.close()
+
+
+def create_storage() -> tuple[BaseStorage, BaseEventIsolation]:
+    if FSM_STORAGE == 'postgres':
+        storage = CachedStorage(DatabaseStorage())
+        return storage, CacheScopeIsolation(DatabaseEventIsolation(), storage)
+
+    if FSM_STORAGE == 'redis':
+        from aiogram.fsm.storage.redis import RedisStorage
+
+        redis_storage = RedisStorage.from_url(REDIS_URL, state_ttl=FSM_TTL, data_ttl=FSM_TTL)
+        storage = CachedStorage(redis_storage)
+        return storage, CacheScopeIsolation(redis_storage.create_isolation(), storage)
+
+    return MemoryStorage(), SimpleEventIsolation()
@@ -1,26 +1,49 @@
+import asyncio
+import json
 import re
 from datetime import datetime
 
-from aiogram import Router, F
+from aiogram import Bot, Router, F
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy import insert
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
-from config import bot, CHAT_ID, MSK
-from db.models import Mailings, Buttons
-from misc.utils import send_mailing
+from config import CHAT_IDS, MSK
+from db.models import Mailings, Buttons, MailingTargets
+from misc.logger import logger
+from misc.payloads import compile_payload
+from misc.schedules import ScheduleError, compile_schedule, is_cron, parse_period
+from misc.scheduler import scheduler
+from misc.utils import update_schedule, extract_media, collect_album
 
 router = Router()
+report_tasks: set[asyncio.Task] = set()
 
+FIRST_SEND_TIMEOUT = 300
 
 PERIODICITY_REGEX = re.compile(r'^(\d+[dhm]\s*)+$')
 GLOBAL_PERIODICITY_REGEX = re.compile(r'^(\d+[Mwd]\s*)+$')
 
+
+def valid_periodicity(value: str | None) -> bool:
+    if not value:
+        return False
+    if PERIODICITY_REGEX.match(value.strip()):
+        return parse_period(value) > 0
+    if not is_cron(value):
+        return False
+
+    try:
+        return compile_schedule(value).next_fire(datetime.now(MSK)) is not None
+    except ScheduleError:
+        return False
+
+
 class MailingCreation(StatesGroup):
     waiting_for_text = State()
     waiting_for_media = State()
@@ -54,19 +77,19 @@ async def process_mailing_text(message: Message, state: FSMContext):
 
     await message.answer(
         "✅ <i>Текст принят!</i>"
-        "\n\n💾 <b>Отправьте фото, видео или GIF для рассылки (одно медиа):</b>",
+        "\n\n💾 <b>Отправьте фото, видео, GIF, документ или альбом для рассылки:</b>",
         reply_markup=builder.as_markup(), parse_mode=ParseMode.HTML
     )
 
 
 @router.callback_query(F.data == "skip_media", MailingCreation.waiting_for_media)
 async def skip_media(cq: CallbackQuery, state: FSMContext):
-    await state.update_data(media=None)
+    await state.update_data(media=None, media_type=None)
     await state.set_state(MailingCreation.waiting_for_per)
     await cq.message.edit_text(
         "▶️ <i>Медиа пропущено!</i>"
         "\n\n🕒 <b>Введите периодичность отправки:</b>\n"
-        "<blockquote>Примеры: <code>30m, 1h, 2d</code></blockquote>",
+        "<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
         ]), parse_mode=ParseMode.HTML
@@ -74,41 +97,59 @@ async def skip_media(cq: CallbackQuery, state: FSMContext):
     await cq.answer()
 
 
-@router.message(MailingCreation.waiting_for_media, F.photo | F.video | F.animation)
+@router.message(MailingCreation.waiting_for_media, F.photo | F.video | F.animation | F.document)
 async def process_mailing_media(message: Message, state: FSMContext):
-    if message.photo:
-        media_id = message.photo[-1].file_id
-    elif message.video:
-        media_id = message.video.file_id
-    elif message.animation:
-        media_id = message.animation.file_id
-    else:
-        return await message.answer('❌ <i>Неверный формат.</i>'
-                                    '\n\n💾 <b>Отправьте фото, видео или GIF для рассылки (одно медиа):</b>',
-                                    reply_markup=InlineKeyboardMarkup(inline_keyboard=[
-                                        [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
-                                    ]), parse_mode=ParseMode.HTML
-                                    )
+    media = extract_media(message)
+
+    if message.media_group_id:
+        if await collect_album(message, state, media):
+            await message.answer(
+                "📎 <i>Альбом загружается...</i>"
+                "\n\n<b>Нажмите «Готово», когда все медиа будут отправлены (до 10 штук).</b>",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="✅ Готово", callback_data="album_done")],
+                    [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
+                ]), parse_mode=ParseMode.HTML
+            )
+        return
 
-    await state.update_data(media=media_id)
+    await state.update_data(media=media[1], media_type=media[0])
     await state.set_state(MailingCreation.waiting_for_per)
 
     await message.answer(
         "✅ <i>Медиа принято!</i>"
         "\n\n🕒 <b>Введите периодичность отправки:</b>\n"
-        "<blockquote>Примеры: <code>30m, 1h, 2d</code></blockquote>",
+        "<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
         reply_markup=InlineKeyboardMarkup(inline_keyboard=[
             [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
         ]), parse_mode=ParseMode.HTML
     )
 
 
+@router.callback_query(F.data == "album_done", MailingCreation.waiting_for_media)
+async def process_mailing_album(cq: CallbackQuery, state: FSMContext):
+    data = await state.get_data()
+
+    await state.update_data(media=json.dumps(data.get('album', [])), media_type='album')
+    await state.set_state(MailingCreation.waiting_for_per)
+
+    await cq.message.edit_text(
+        "✅ <i>Альбом принят!</i>"
+        "\n\n🕒 <b>Введите периодичность отправки:</b>\n"
+        "<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
+        ]), parse_mode=ParseMode.HTML
+    )
+    await cq.answer()
+
+
 @router.message(MailingCreation.waiting_for_per)
 async def process_periodicity(message: Message, state: FSMContext):
-    if not message.text or not PERIODICITY_REGEX.match(message.text.strip()):
+    if not valid_periodicity(message.text):
         return await message.answer("❌ <i>Неверный формат.</i>"
                                     "\n\n🕒 <b>Введите периодичность отправки:</b>\n"
-                                    "<blockquote>Примеры: <code>30m, 1h, 2d</code></blockquote>",
+                                    "<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
                                     reply_markup=InlineKeyboardMarkup(inline_keyboard=[
                                         [InlineKeyboardButton(text="❌ Отмена", callback_data="cancel_creation")]
                                     ]), parse_mode=ParseMode.HTML)
@@ -194,60 +235,14 @@ async def show_confirmation(message: Message, state: FSMContext):
 
     text = data.get('text', 'Нет текста')
     media = data.get('media')
+    media_type = data.get('media_type')
     buttons = data.get('buttons', [])
 
-    reply_markup = None
-    if buttons:
-        kb = InlineKeyboardBuilder()
-        for btn in buttons:
-            kb.add(InlineKeyboardButton(text=btn['text'], url=btn['url']))
-        kb.adjust(1)
-        reply_markup = kb.as_markup()
-
     try:
-        if media:
-            if isinstance(media, str):
-                if media.startswith('AgAC'):
-                    await message.answer_photo(
-                        media,
-                        caption=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                elif media.startswith('BAAC'):
-                    await message.answer_video(
-                        media,
-                        caption=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                elif media.startswith('CgAC'):
-                    await message.answer_animation(
-                        media,
-                        caption=text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-                else:
-                    await message.answer(
-                        text,
-                        parse_mode=ParseMode.HTML,
-                        reply_markup=reply_markup
-                    )
-            else:
-                await message.answer(
-                    text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-        else:
-            await message.answer(
-                text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
+        payload = compile_payload(text, media, media_type, [(btn['text'], btn['url']) for btn in buttons])
+        await payload.send(message.bot, message.chat.id)
     except Exception as e:
-        print(f"Ошибка при отправке сообщения: {e}")
+        logger.warning('Ошибка при отправке предпросмотра', extra={'error': str(e)})
         await message.answer(
             "❌ <b>Произошла ошибка при создании предпросмотра. Проверьте данные и попробуйте еще раз.</b>"
         , parse_mode=ParseMode.HTML)
@@ -260,8 +255,12 @@ async def show_confirmation(message: Message, state: FSMContext):
     )
     confirm_kb.adjust(1)
 
+    warning = ''
+    if media_type == 'album' and buttons:
+        warning = "⚠️ <i>Кнопки не прикрепляются к альбомам и не будут отправлены.</i>\n\n"
+
     await message.answer(
-        "📢 <b>Вы подтверждаете создание рассылки?</b>",
+        warning + "📢 <b>Вы подтверждаете создание рассылки?</b>",
         reply_markup=confirm_kb.as_markup(), parse_mode=ParseMode.HTML
     )
 
@@ -270,53 +269,74 @@ async def show_confirmation(message: Message, state: FSMContext):
 
 @router.callback_query(F.data == "confirm_mailing", MailingCreation.confirmation)
 async def confirm_mailing(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
+    await cq.answer()
     data = await state.get_data()
 
     mailing = Mailings(
         text=data['text'],
         media=data.get('media'),
+        media_type=data.get('media_type'),
         per=data['per'],
         globalper=data['globalper'],
         status=True
     )
+    update_schedule(mailing)
 
     session.add(mailing)
+    await session.flush()
+
+    if data.get('buttons'):
+        await session.execute(insert(Buttons), [
+            {'mailing_id': mailing.id, 'text': btn_data['text'], 'url': btn_data['url']}
+            for btn_data in data['buttons']
+        ])
+    if CHAT_IDS:
+        await session.execute(insert(MailingTargets), [
+            {'mailing_id': mailing.id, 'chat_id': chat_id} for chat_id in CHAT_IDS
+        ])
+
     await session.commit()
-    await session.refresh(mailing)
-
-    if 'buttons' in data and data['buttons']:
-        for btn_data in data['buttons']:
-            button = Buttons(
-                mailing_id=mailing.id,
-                text=btn_data['text'],
-                url=btn_data['url']
-            )
-            session.add(button)
-        await session.commit()
 
     await state.clear()
-    await cq.message.edit_text("✅ <b>Рассылка успешно создана!</b>", parse_mode=ParseMode.HTML)
 
-    try:
-        from db.models import async_session as new_async_session
-        async with new_async_session() as new_session:
-            fresh_mailing = await new_session.get(
-                Mailings,
-                mailing.id,
-                options=[selectinload(Mailings.buttons)]
-            )
+    scheduler.notify(mailing)
 
-            message_id = await send_mailing(cq.bot, CHAT_ID, fresh_mailing)
+    if not CHAT_IDS:
+        note = "У рассылки нет чатов. Добавьте их в настройках рассылки."
+    elif mailing.next_due_at is None:
+        note = "Рассылка не запланирована."
+    elif mailing.next_due_at > datetime.now(MSK):
+        note = f"Первая отправка запланирована на {mailing.next_due_at.astimezone(MSK):%d.%m %H:%M} МСК."
+    elif not scheduler.running:
+        note = "Первая отправка поставлена в очередь. Рассылки отправляет отдельный процесс, отчёта не будет."
+    else:
+        note = "Первая отправка поставлена в очередь, о результате придёт сообщение."
+        task = asyncio.create_task(report_first_send(cq.bot, cq.message.chat.id, mailing.id,
+                                                     scheduler.watch(mailing.id)))
+        report_tasks.add(task)
+        task.add_done_callback(report_tasks.discard)
 
-            if message_id:
-                fresh_mailing.last_sent = datetime.now(MSK)
-                fresh_mailing.last_message_id = message_id
-                await new_session.commit()
+    await cq.message.edit_text(f"✅ <b>Рассылка успешно создана!</b>\n\n<i>{note}</i>", parse_mode=ParseMode.HTML)
 
-    except Exception as e:
-        print(f"Ошибка при первой отправке рассылки: {e}")
 
-    await cq.answer()
+async def report_first_send(bot: Bot, chat_id: int, mailing_id: int, result: asyncio.Future):
+    try:
+        delivered, total = await asyncio.wait_for(result, FIRST_SEND_TIMEOUT)
+    except asyncio.TimeoutError:
+        text = (f"⏳ <b>Рассылка #{mailing_id} ещё не отправлена.</b>"
+                "\n\n<i>Отправка задерживается из-за очереди или лимитов Telegram.</i>")
+    else:
+        if delivered == total:
+            text = f"📬 <b>Рассылка #{mailing_id} отправлена во все чаты ({total}).</b>"
+        elif delivered:
+            text = f"⚠️ <b>Рассылка #{mailing_id} отправлена в {delivered} из {total} чатов.</b>"
+        else:
+            text = f"❌ <b>Рассылку #{mailing_id} не удалось отправить.</b>\n\n<i>Проверьте права бота в чатах.</i>"
+
+    try:
+        await bot.send_message(chat_id=chat_id, text=text, parse_mode=ParseMode.HTML)
+    except Exception as e:
+        logger.warning('Не удалось сообщить о первой отправке', extra={'mailing_id': mailing_id, 'error': str(e)})
 
 
 @router.callback_query(F.data == "cancel_creation")
@@ -1,3 +1,6 @@
+import json
+import re
+
 from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramBadRequest
@@ -5,23 +8,34 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import StatesGroup, State
 from aiogram.types import CallbackQuery, InlineKeyboardButton, Message, InlineKeyboardMarkup
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy import delete
+from sqlalchemy import delete, select, update
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
-from db.models import Mailings, Buttons
-from handlers.creating_mailings import PERIODICITY_REGEX, GLOBAL_PERIODICITY_REGEX
+from db.models import Mailings, Buttons, MailingTargets
+from handlers.creating_mailings import GLOBAL_PERIODICITY_REGEX, valid_periodicity
 from handlers.start import get_mailings_with_buttons
+from misc.cleanup import mark_stale
+from misc.logger import logger
+from misc.payloads import payload_cache, mailing_cache, MailingCard
+from misc.scheduler import scheduler
+from misc.schedules import QuietHours, ScheduleError
+from misc.utils import update_schedule, bump_version, replace_buttons, extract_media, collect_album, SEND_MODES
 
 router = Router()
 
 
+CHAT_ID_REGEX = re.compile(r'^-?\d+$')
+CARD_PROMPT = "📝 <b>Что хотите изменить?</b>"
+MAX_MESSAGE_LENGTH = 4096
+
 class MailingEditing(StatesGroup):
     waiting_for_text = State()
     waiting_for_media = State()
     waiting_for_per = State()
     waiting_for_globalper = State()
+    waiting_for_quiet_hours = State()
     waiting_for_buttons = State()
+    waiting_for_chats = State()
     waiting_for_delete_confirmation = State()
 
 
@@ -36,12 +50,20 @@ def kb_edits(mailing):
         InlineKeyboardButton(text="🗓️ Изменить глоб. периодичность", callback_data=f"edit_globalper_{mailing.id}")
     )
     builder.row(
-        InlineKeyboardButton(text="🎛️ Изменить кнопки", callback_data=f"edit_buttons_{mailing.id}")
+        InlineKeyboardButton(text="🌙 Тихие часы", callback_data=f"edit_quiet_{mailing.id}")
+    )
+    builder.row(
+        InlineKeyboardButton(text="🎛️ Изменить кнопки", callback_data=f"edit_buttons_{mailing.id}"),
+        InlineKeyboardButton(text="🎯 Изменить чаты", callback_data=f"edit_chats_{mailing.id}")
     )
     builder.row(
         InlineKeyboardButton(text='🟢 Рассылка включена!' if mailing.status else '🔴 Рассылка выключена.',
                              callback_data=f"toggle_status_{mailing.id}")
     )
+    builder.row(
+        InlineKeyboardButton(text=f"🔁 Режим: {SEND_MODES.get(mailing.send_mode, SEND_MODES['replace'])}",
+                             callback_data=f"send_mode_{mailing.id}")
+    )
     builder.row(
         InlineKeyboardButton(text="❌ УДАЛИТЬ РАССЫЛКУ", callback_data=f"delete_mailing_{mailing.id}")
     )
@@ -52,6 +74,38 @@ def kb_edits(mailing):
     return builder
 
 
+def inline_preview(card: MailingCard) -> str | None:
+    payload = payload_cache.get(card)
+    if payload.method != 'message' or not payload.text:
+        return None
+
+    text = f"{payload.text}\n\n➖➖➖➖➖\n\n{CARD_PROMPT}"
+    return text if len(text) <= MAX_MESSAGE_LENGTH else None
+
+
+def render_card(card: MailingCard) -> tuple[str, InlineKeyboardMarkup]:
+    builder = kb_edits(card)
+    text = inline_preview(card)
+    if text is None:
+        return CARD_PROMPT, builder.as_markup()
+
+    preview = payload_cache.get(card).reply_markup
+    rows = preview.inline_keyboard if preview else []
+    return text, InlineKeyboardMarkup(inline_keyboard=[*rows, *builder.export()])
+
+
+async def edit_card(message: Message, card: MailingCard) -> bool:
+    text, markup = render_card(card)
+    try:
+        await message.edit_text(text, parse_mode=ParseMode.HTML, reply_markup=markup)
+    except TelegramBadRequest as e:
+        if 'message is not modified' not in e.message:
+            logger.warning('Не удалось обновить карточку рассылки', extra={'mailing_id': card.id, 'error': str(e)})
+            return False
+
+    return True
+
+
 async def kb_back(mailing_id: int):
     builder = InlineKeyboardBuilder()
     builder.add(InlineKeyboardButton(text="🔙 Назад", callback_data=f"back_to_{mailing_id}"))
@@ -63,76 +117,38 @@ async def kb_back(mailing_id: int):
 async def mailing_editing_handler(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
     mailing_id = int(cq.data.split("_")[1])
 
-    mailing = await session.get(Mailings, mailing_id, options=[selectinload(Mailings.buttons)])
+    card = await mailing_cache.get(session, mailing_id)
 
-    if not mailing:
+    if not card:
         return
 
-    await cq.message.delete()
+    await state.update_data(
+        mailing_id=card.id,
+    )
+    await cq.answer()
 
-    reply_markup = None
-    if mailing.buttons:
-        kb = InlineKeyboardBuilder()
-        for btn in mailing.buttons:
-            kb.add(InlineKeyboardButton(text=btn.text, url=btn.url))
-        kb.adjust(1)
-        reply_markup = kb.as_markup()
+    if inline_preview(card) and await edit_card(cq.message, card):
+        return
+
+    await cq.message.delete()
 
     try:
-        if mailing.media:
-            if mailing.media.startswith('AgAC'):
-                await cq.message.answer_photo(
-                    str(mailing.media),
-                    caption=str(mailing.text),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            elif mailing.media.startswith('BAAC'):
-                await cq.message.answer_video(
-                    str(mailing.media),
-                    caption=str(mailing.text),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            elif mailing.media.startswith('CgAC'):
-                await cq.message.answer_animation(
-                    str(mailing.media),
-                    caption=str(mailing.text),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            else:
-                await cq.message.answer(
-                    str(mailing.text),
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-        else:
-            await cq.message.answer(
-                str(mailing.text),
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
+        await payload_cache.get(card).send(cq.bot, cq.message.chat.id)
     except Exception as e:
-        print(f"Ошибка при отправке рассылки: {e}")
+        logger.warning('Ошибка при отображении рассылки', extra={'mailing_id': card.id, 'error': str(e)})
         await cq.message.answer(
             "❌ Ошибка при отображении рассылки",
             parse_mode=ParseMode.HTML
         )
 
-    builder = kb_edits(mailing)
+    builder = kb_edits(card)
 
     await cq.message.answer(
-        "📝 <b>Что хотите изменить?</b>",
+        CARD_PROMPT,
         parse_mode=ParseMode.HTML,
         reply_markup=builder.as_markup()
     )
 
-    await state.update_data(
-        mailing_id=mailing.id,
-    )
-    await cq.answer()
-
 
 @router.callback_query(F.data.startswith("edit_text_"))
 async def edit_text_handler(cq: CallbackQuery, state: FSMContext):
@@ -158,7 +174,9 @@ async def process_new_text(message: Message, session: AsyncSession, state: FSMCo
 
     mailing = await session.get(Mailings, mailing_id)
     mailing.text = message.html_text
+    mailing.version += 1
     await session.commit()
+    mailing_cache.invalidate(mailing.id)
 
     await message.answer(
         text="✅ <b>Текст рассылки успешно обновлен!</b>",
@@ -180,7 +198,7 @@ async def edit_media_handler(cq: CallbackQuery, state: FSMContext):
     builder.adjust(1)
 
     await cq.message.edit_text(
-        text="💾 <b>Отправьте новое фото, видео или GIF:</b>",
+        text="💾 <b>Отправьте новое фото, видео, GIF, документ или альбом:</b>",
         parse_mode=ParseMode.HTML,
         reply_markup=builder.as_markup()
     )
@@ -194,7 +212,10 @@ async def remove_media_handler(cq: CallbackQuery, session: AsyncSession, state:
 
     mailing = await session.get(Mailings, mailing_id)
     mailing.media = None
+    mailing.media_type = None
+    mailing.version += 1
     await session.commit()
+    mailing_cache.invalidate(mailing.id)
 
     await cq.message.edit_text(
         "✅ <b>Медиа удалено из рассылки!</b>",
@@ -205,24 +226,29 @@ async def remove_media_handler(cq: CallbackQuery, session: AsyncSession, state:
     await cq.answer()
 
 
-@router.message(MailingEditing.waiting_for_media, F.photo | F.video | F.animation)
+@router.message(MailingEditing.waiting_for_media, F.photo | F.video | F.animation | F.document)
 async def process_new_media(message: Message, session: AsyncSession, state: FSMContext):
     data = await state.get_data()
     mailing_id = data.get('mailing_id')
-
-    if message.photo:
-        media_id = message.photo[-1].file_id
-    elif message.video:
-        media_id = message.video.file_id
-    elif message.animation:
-        media_id = message.animation.file_id
-    else:
-        return await message.answer("❌ Неверный формат.\n\n💾 <b>Отправьте новое фото, видео или GIF:</b>",
-                                    parse_mode=ParseMode.HTML)
+    media = extract_media(message)
+
+    if message.media_group_id:
+        if await collect_album(message, state, media):
+            await message.answer(
+                "📎 <i>Альбом загружается...</i>"
+                "\n\n<b>Нажмите «Готово», когда все медиа будут отправлены (до 10 штук).</b>",
+                reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+                    [InlineKeyboardButton(text="✅ Готово", callback_data="album_done")],
+                    [InlineKeyboardButton(text="🔙 Назад", callback_data=f"back_to_{mailing_id}")]
+                ]), parse_mode=ParseMode.HTML
+            )
+        return
 
     mailing = await session.get(Mailings, mailing_id)
-    mailing.media = media_id
+    mailing.media_type, mailing.media = media
+    mailing.version += 1
     await session.commit()
+    mailing_cache.invalidate(mailing.id)
 
     await message.answer(
         text="✅ <b>Медиа рассылки успешно обновлено!</b>",
@@ -232,6 +258,26 @@ async def process_new_media(message: Message, session: AsyncSession, state: FSMC
     await state.clear()
 
 
+@router.callback_query(F.data == "album_done", MailingEditing.waiting_for_media)
+async def process_new_album(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
+    data = await state.get_data()
+
+    mailing = await session.get(Mailings, data.get('mailing_id'))
+    mailing.media = json.dumps(data.get('album', []))
+    mailing.media_type = 'album'
+    mailing.version += 1
+    await session.commit()
+    mailing_cache.invalidate(mailing.id)
+
+    await cq.message.edit_text(
+        text="✅ <b>Альбом рассылки успешно обновлён!</b>",
+        parse_mode=ParseMode.HTML
+    )
+
+    await state.clear()
+    await cq.answer()
+
+
 @router.callback_query(F.data.startswith("edit_per_"))
 async def edit_per_handler(cq: CallbackQuery, state: FSMContext):
     mailing_id = int(cq.data.split("_")[2])
@@ -242,7 +288,7 @@ async def edit_per_handler(cq: CallbackQuery, state: FSMContext):
 
     await cq.message.edit_text(
         text="🕒 <b>Введите новую периодичность отправки:</b>"
-             "\n<blockquote>Примеры: <code>30m, 1h, 2d</code></blockquote>",
+             "\n<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
         parse_mode=ParseMode.HTML,
         reply_markup=builder.as_markup()
     )
@@ -252,10 +298,10 @@ async def edit_per_handler(cq: CallbackQuery, state: FSMContext):
 
 @router.message(MailingEditing.waiting_for_per)
 async def process_new_per(message: Message, session: AsyncSession, state: FSMContext):
-    if not message.text or not PERIODICITY_REGEX.match(message.text.strip()):
+    if not valid_periodicity(message.text):
         return await message.answer("❌ <i>Неверный формат.</i>"
                                     "\n\n🕒 <b>Введите новую периодичность отправки:</b>\n"
-                                    "<blockquote>Примеры: <code>30m, 1h, 2d</code></blockquote>",
+                                    "<blockquote>Примеры: <code>30m, 1h, 2d</code> или cron по МСК: <code>0 10 * * 1-5</code></blockquote>",
                                     parse_mode=ParseMode.HTML)
 
     data = await state.get_data()
@@ -263,7 +309,9 @@ async def process_new_per(message: Message, session: AsyncSession, state: FSMCon
 
     mailing = await session.get(Mailings, mailing_id)
     mailing.per = message.text
+    update_schedule(mailing)
     await session.commit()
+    scheduler.notify(mailing)
 
     await message.answer(
         text="✅ <b>Периодичность рассылки успешно обновлена!</b>",
@@ -304,7 +352,9 @@ async def process_new_globalper(message: Message, session: AsyncSession, state:
 
     mailing = await session.get(Mailings, mailing_id)
     mailing.globalper = message.text
+    update_schedule(mailing)
     await session.commit()
+    scheduler.notify(mailing)
 
     await message.answer(
         text="✅ <b>Глобальная периодичность рассылки успешно обновлена!</b>",
@@ -314,6 +364,81 @@ async def process_new_globalper(message: Message, session: AsyncSession, state:
     await state.clear()
 
 
+@router.callback_query(F.data.startswith("edit_quiet_"))
+async def edit_quiet_hours_handler(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
+    mailing_id = int(cq.data.split("_")[2])
+    await state.set_state(MailingEditing.waiting_for_quiet_hours)
+    await state.update_data(mailing_id=mailing_id)
+
+    mailing = await session.get(Mailings, mailing_id)
+    current = f"<code>{mailing.quiet_hours}</code>" if mailing and mailing.quiet_hours else "<i>не заданы</i>"
+
+    builder = InlineKeyboardBuilder()
+    builder.add(InlineKeyboardButton(text="❌ Убрать тихие часы", callback_data=f"remove_quiet_{mailing_id}"))
+    builder.add(InlineKeyboardButton(text="🔙 Назад", callback_data=f"back_to_{mailing_id}"))
+    builder.adjust(1)
+
+    await cq.message.edit_text(
+        text=f"🌙 <b>Текущие тихие часы:</b> {current}\n\n"
+             "<b>Введите окна по МСК, в которые рассылка не отправляется:</b>"
+             "\n<blockquote>Примеры: <code>22:00-08:00</code>, <code>13:00-14:00, 23:00-07:00</code></blockquote>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=builder.as_markup()
+    )
+
+    await cq.answer()
+
+
+@router.callback_query(F.data.startswith("remove_quiet_"))
+async def remove_quiet_hours_handler(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
+    mailing_id = int(cq.data.split("_")[2])
+
+    mailing = await session.get(Mailings, mailing_id)
+    mailing.quiet_hours = None
+    update_schedule(mailing)
+    await session.commit()
+    scheduler.notify(mailing)
+
+    await cq.message.edit_text(
+        "✅ <b>Тихие часы убраны!</b>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=[
+            [InlineKeyboardButton(text="🔙 Назад", callback_data=f"back_to_{mailing_id}")]
+        ])
+    )
+
+    await state.clear()
+    await cq.answer()
+
+
+@router.message(MailingEditing.waiting_for_quiet_hours)
+async def process_new_quiet_hours(message: Message, session: AsyncSession, state: FSMContext):
+    try:
+        QuietHours(message.text or '')
+    except ScheduleError:
+        return await message.answer("❌ <i>Неверный формат.</i>"
+                                    "\n\n🌙 <b>Введите окна по МСК, в которые рассылка не отправляется:</b>"
+                                    "\n<blockquote>Примеры: <code>22:00-08:00</code>, "
+                                    "<code>13:00-14:00, 23:00-07:00</code></blockquote>",
+                                    parse_mode=ParseMode.HTML)
+
+    data = await state.get_data()
+    mailing_id = data.get('mailing_id')
+
+    mailing = await session.get(Mailings, mailing_id)
+    mailing.quiet_hours = message.text.strip()
+    update_schedule(mailing)
+    await session.commit()
+    scheduler.notify(mailing)
+
+    await message.answer(
+        text="✅ <b>Тихие часы рассылки успешно обновлены!</b>",
+        parse_mode=ParseMode.HTML
+    )
+
+    await state.clear()
+
+
 @router.callback_query(F.data.startswith("edit_buttons_"))
 async def edit_buttons_handler(cq: CallbackQuery, state: FSMContext):
     mailing_id = int(cq.data.split("_")[2])
@@ -343,7 +468,9 @@ async def remove_buttons_handler(cq: CallbackQuery, session: AsyncSession, state
     mailing_id = int(cq.data.split("_")[2])
 
     await session.execute(delete(Buttons).where(Buttons.mailing_id == mailing_id))
+    await bump_version(session, mailing_id)
     await session.commit()
+    mailing_cache.invalidate(mailing_id)
 
     await cq.message.edit_text(
         "✅ <b>Кнопки удалены из рассылки!</b>",
@@ -362,8 +489,6 @@ async def process_new_buttons(message: Message, session: AsyncSession, state: FS
     data = await state.get_data()
     mailing_id = data.get('mailing_id')
 
-    await session.execute(delete(Buttons).where(Buttons.mailing_id == mailing_id))
-
     buttons_data = []
     lines = message.text.split('\n')
 
@@ -389,15 +514,10 @@ async def process_new_buttons(message: Message, session: AsyncSession, state: FS
                                                                       callback_data=f"back_to_{mailing_id}")]
                                             ]), parse_mode=ParseMode.HTML)
 
-    for btn_data in buttons_data:
-        button = Buttons(
-            mailing_id=mailing_id,
-            text=btn_data['text'],
-            url=btn_data['url']
-        )
-        session.add(button)
-
+    await replace_buttons(session, mailing_id, [(btn['text'], btn['url']) for btn in buttons_data])
+    await bump_version(session, mailing_id)
     await session.commit()
+    mailing_cache.invalidate(mailing_id)
 
     await message.answer(
         text="✅ <b>Кнопки рассылки успешно обновлены!</b>",
@@ -407,6 +527,67 @@ async def process_new_buttons(message: Message, session: AsyncSession, state: FS
     await state.clear()
 
 
+@router.callback_query(F.data.startswith("edit_chats_"))
+async def edit_chats_handler(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
+    mailing_id = int(cq.data.split("_")[2])
+    await state.set_state(MailingEditing.waiting_for_chats)
+    await state.update_data(mailing_id=mailing_id)
+
+    chat_ids = (await session.execute(
+        select(MailingTargets.chat_id).where(MailingTargets.mailing_id == mailing_id)
+    )).scalars().all()
+    current = "\n".join(f"<code>{chat_id}</code>" for chat_id in chat_ids) or "<i>нет чатов</i>"
+
+    builder = await kb_back(mailing_id)
+
+    await cq.message.edit_text(
+        text=f"🎯 <b>Текущие чаты рассылки:</b>\n<blockquote>{current}</blockquote>\n\n"
+             "<b>Отправьте новый список ID чатов:</b>\n"
+             "💡 <i>Каждый чат с новой строки или через пробел!</i>",
+        parse_mode=ParseMode.HTML,
+        reply_markup=builder.as_markup()
+    )
+
+    await cq.answer()
+
+
+@router.message(MailingEditing.waiting_for_chats)
+async def process_new_chats(message: Message, session: AsyncSession, state: FSMContext):
+    data = await state.get_data()
+    mailing_id = data.get('mailing_id')
+
+    parts = (message.text or '').replace(',', ' ').split()
+    if not parts or not all(CHAT_ID_REGEX.match(part) for part in parts):
+        return await message.answer("❌ <i>Неверный формат.</i>"
+                                    "\n\n🎯 <b>Отправьте новый список ID чатов:</b>\n"
+                                    "💡 <i>Каждый чат с новой строки или через пробел!</i>",
+                                    parse_mode=ParseMode.HTML)
+
+    chat_ids = {int(part) for part in parts}
+
+    existing = set((await session.execute(
+        select(MailingTargets.chat_id).where(MailingTargets.mailing_id == mailing_id)
+    )).scalars().all())
+
+    removed = existing - chat_ids
+    if removed:
+        await session.execute(delete(MailingTargets).where(MailingTargets.mailing_id == mailing_id,
+                                                           MailingTargets.chat_id.in_(removed)))
+        await mark_stale(session, mailing_id, removed)
+
+    for chat_id in chat_ids - existing:
+        session.add(MailingTargets(mailing_id=mailing_id, chat_id=chat_id))
+
+    await session.commit()
+
+    await message.answer(
+        text="✅ <b>Чаты рассылки успешно обновлены!</b>",
+        parse_mode=ParseMode.HTML
+    )
+
+    await state.clear()
+
+
 @router.callback_query(F.data.startswith("delete_mailing_"))
 async def delete_mailing_handler(cq: CallbackQuery, state: FSMContext):
     mailing_id = int(cq.data.split("_")[2])
@@ -434,7 +615,10 @@ async def confirm_delete_handler(cq: CallbackQuery, session: AsyncSession, state
     mailing_id = int(cq.data.split("_")[2])
 
     await session.delete(await session.get(Mailings, mailing_id))
+    await mark_stale(session, mailing_id)
     await session.commit()
+    scheduler.remove(mailing_id)
+    mailing_cache.invalidate(mailing_id)
 
     await cq.message.edit_text(
         "✅ <b>Рассылка успешно удалена!</b>",
@@ -448,15 +632,43 @@ async def confirm_delete_handler(cq: CallbackQuery, session: AsyncSession, state
 @router.callback_query(F.data.startswith("toggle_status_"))
 async def toggle_mailing_status(cq: CallbackQuery, session: AsyncSession):
     mailing_id = int(cq.data.split("_")[2])
+    card = await mailing_cache.get(session, mailing_id)
     mailing = await session.get(Mailings, mailing_id)
 
     mailing.status = not mailing.status
+    update_schedule(mailing)
+    if not mailing.status:
+        await mark_stale(session, mailing_id)
+        await session.execute(update(MailingTargets)
+                              .where(MailingTargets.mailing_id == mailing_id)
+                              .values(last_message_id=None, extra_message_ids=None))
     await session.commit()
+    scheduler.notify(mailing)
+    mailing_cache.invalidate(mailing_id)
 
-    builder = kb_edits(mailing)
+    _, markup = render_card(card._replace(status=mailing.status))
 
     await cq.message.edit_reply_markup(
-        reply_markup=builder.as_markup()
+        reply_markup=markup
+    )
+
+
+@router.callback_query(F.data.startswith("send_mode_"))
+async def switch_send_mode(cq: CallbackQuery, session: AsyncSession):
+    mailing_id = int(cq.data.split("_")[2])
+    card = await mailing_cache.get(session, mailing_id)
+
+    modes = list(SEND_MODES)
+    current = card.send_mode if card.send_mode in SEND_MODES else 'replace'
+    send_mode = modes[(modes.index(current) + 1) % len(modes)]
+    await session.execute(update(Mailings).where(Mailings.id == mailing_id).values(send_mode=send_mode))
+    await session.commit()
+    mailing_cache.invalidate(mailing_id)
+
+    _, markup = render_card(card._replace(send_mode=send_mode))
+
+    await cq.message.edit_reply_markup(
+        reply_markup=markup
     )
 
 
@@ -478,17 +690,16 @@ async def back_to_mailings_handler(cq: CallbackQuery, session: AsyncSession, sta
 @router.callback_query(F.data.startswith("back_to_"))
 async def back_to_mailing(cq: CallbackQuery, session: AsyncSession, state: FSMContext):
     mailing_id = int(cq.data.split("_")[2])
-    mailing = await session.get(Mailings, mailing_id, options=[selectinload(Mailings.buttons)])
+    card = await mailing_cache.get(session, mailing_id)
 
-    builder = kb_edits(mailing)
-
-    await cq.message.edit_text(
-        "📝 <b>Что хотите изменить?</b>",
-        parse_mode=ParseMode.HTML,
-        reply_markup=builder.as_markup()
-    )
+    if not card:
+        return await cq.answer()
 
     await state.update_data(
-        mailing_id=mailing.id,
+        mailing_id=card.id,
     )
     await cq.answer()
+
+    if not await edit_card(cq.message, card):
+        text, markup = render_card(card)
+        await cq.message.answer(text, parse_mode=ParseMode.HTML, reply_markup=markup)
@@ -1,7 +1,7 @@
-from aiogram import Router
+from aiogram import Router, F
 from aiogram.enums import ParseMode
 from aiogram.filters import Command
-from aiogram.types import Message
+from aiogram.types import Message, CallbackQuery
 from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import ADMIN_IDS
@@ -22,4 +22,20 @@ async def admin(message: Message, session: AsyncSession):
     await message.answer(
         "📦 <b>Меню рассылок:</b>", parse_mode=ParseMode.HTML,
         reply_markup=builder.as_markup()
-    )
\ No newline at end of file
+    )
+
+
+@router.callback_query(F.data.startswith('mailings_'))
+async def mailings_page(cq: CallbackQuery, session: AsyncSession):
+    _, direction, mailing_id = cq.data.split('_')
+
+    if direction == 'before':
+        builder = await get_mailings_with_buttons(session, before_id=int(mailing_id))
+    else:
+        builder = await get_mailings_with_buttons(session, after_id=int(mailing_id))
+
+    await cq.message.edit_text(
+        "📦 <b>Меню рассылок:</b>", parse_mode=ParseMode.HTML,
+        reply_markup=builder.as_markup()
+    )
+    await cq.answer()
\ No newline at end of file
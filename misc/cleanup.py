@@ -0,0 +1,138 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime, timedelta
+from functools import partial
+
+from aiogram import Bot
+from sqlalchemy import select, update, delete, insert, bindparam, exists, true
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from config import MSK, CLEANUP_INTERVAL, CLEANUP_BATCH
+from db.models import Mailings, SentMessages, session_scope
+from misc.logger import logger
+from misc.metrics import CLEANUP_DELETED
+from misc.sender import sender
+
+DELETE_WINDOW = timedelta(hours=48)
+DELETE_CHUNK = 100
+
+sent_table = SentMessages.__table__
+INSERT_SENT = insert(sent_table)
+MESSAGE_MATCH = ((sent_table.c.mailing_id == bindparam('b_mailing_id'))
+                 & (sent_table.c.chat_id == bindparam('b_chat_id'))
+                 & (sent_table.c.message_id == bindparam('b_message_id')))
+MARK_STALE = update(sent_table).where(MESSAGE_MATCH).values(stale=True)
+FORGET_SENT = delete(sent_table).where(MESSAGE_MATCH)
+
+
+def message_rows(mailing_id: int, chat_id: int, message_ids: list[int]) -> list[dict]:
+    return [{'b_mailing_id': mailing_id, 'b_chat_id': chat_id, 'b_message_id': message_id}
+            for message_id in message_ids]
+
+
+async def record_deliveries(session: AsyncSession, deliveries: list[tuple[int, datetime, list[tuple]]]):
+    sent, stale, removed = [], [], []
+    for mailing_id, sent_at, messages in deliveries:
+        for chat_id, previous_ids, message_ids, stale_ids in messages:
+            sent += [{'mailing_id': mailing_id, 'chat_id': chat_id, 'message_id': message_id, 'sent_at': sent_at}
+                     for message_id in message_ids if message_id not in previous_ids]
+            stale += message_rows(mailing_id, chat_id, stale_ids)
+            removed += message_rows(mailing_id, chat_id, [message_id for message_id in previous_ids
+                                                          if message_id not in message_ids
+                                                          and message_id not in stale_ids])
+
+    if sent:
+        await session.execute(INSERT_SENT, sent)
+        await session.execute(
+            update(SentMessages)
+            .where(SentMessages.mailing_id.in_({row['mailing_id'] for row in sent}), SentMessages.stale == False,
+                   ~exists().where(Mailings.id == SentMessages.mailing_id, Mailings.status == True))
+            .values(stale=True)
+        )
+    if stale:
+        await session.execute(MARK_STALE, stale)
+    if removed:
+        await session.execute(FORGET_SENT, removed)
+
+
+async def mark_stale(session: AsyncSession, mailing_id: int, chat_ids: set[int] | None = None):
+    stmt = update(SentMessages).where(SentMessages.mailing_id == mailing_id, SentMessages.stale == False)
+    if chat_ids is not None:
+        stmt = stmt.where(SentMessages.chat_id.in_(chat_ids))
+
+    await session.execute(stmt.values(stale=True))
+
+
+class MessageCleaner:
+    def __init__(self):
+        self.shard: int = 0
+        self.shards: int = 1
+        self._task: asyncio.Task | None = None
+
+    def _in_shard(self):
+        if self.shards == 1:
+            return true()
+        return SentMessages.mailing_id % self.shards == self.shard
+
+    async def _claim(self, session: AsyncSession) -> list:
+        claimed = (
+            select(SentMessages.id)
+            .where(SentMessages.stale == True, self._in_shard())
+            .order_by(SentMessages.chat_id)
+            .limit(CLEANUP_BATCH)
+            .with_for_update(skip_locked=True)
+        )
+        rows = (await session.execute(
+            delete(SentMessages)
+            .where(SentMessages.id.in_(claimed.scalar_subquery()))
+            .returning(SentMessages.chat_id, SentMessages.message_id, SentMessages.sent_at)
+        )).all()
+        await session.commit()
+
+        return rows
+
+    async def purge(self, bot: Bot) -> int:
+        async with session_scope() as session:
+            rows = await self._claim(session)
+
+        threshold = datetime.now(MSK) - DELETE_WINDOW
+        by_chat: dict[int, list[int]] = defaultdict(list)
+        for chat_id, message_id, sent_at in rows:
+            if sent_at > threshold:
+                by_chat[chat_id].append(message_id)
+
+        jobs = [
+            sender.submit(chat_id, partial(bot.delete_messages, chat_id=chat_id,
+                                           message_ids=message_ids[i:i + DELETE_CHUNK]))
+            for chat_id, message_ids in by_chat.items()
+            for i in range(0, len(message_ids), DELETE_CHUNK)
+        ]
+        for result in await asyncio.gather(*jobs, return_exceptions=True):
+            if isinstance(result, Exception):
+                logger.warning('Не удалось удалить устаревшие сообщения', extra={'error': str(result)})
+        CLEANUP_DELETED.inc(amount=sum(len(message_ids) for message_ids in by_chat.values()))
+
+        return len(rows)
+
+    async def run(self, bot: Bot):
+        while True:
+            try:
+                while await self.purge(bot) == CLEANUP_BATCH:
+                    pass
+            except Exception as e:
+                logger.exception('Ошибка при очистке сообщений')
+
+            await asyncio.sleep(CLEANUP_INTERVAL)
+
+    def start(self, bot: Bot, shard: int = 0, shards: int = 1):
+        self.shard, self.shards = shard, shards
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+
+cleaner = MessageCleaner()
@@ -0,0 +1,193 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.methods import TelegramMethod, Response
+from aiohttp import web
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+registry: list['Metric'] = []
+
+
+def format_labels(names: tuple[str, ...], values: tuple) -> str:
+    if not names:
+        return ''
+
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+
+    return '{' + ','.join(pairs) + '}'
+
+
+class Metric:
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        registry.append(self)
+
+    def collect(self) -> list[str]:
+        return []
+
+    def reset(self):
+        pass
+
+    def render(self) -> list[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}', *self.collect()]
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def value(self, *labels) -> float:
+        return self._values.get(labels, 0)
+
+    def reset(self):
+        self._values.clear()
+
+    def collect(self) -> list[str]:
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in self._values.items()]
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, documentation, labels)
+        self._values: dict[tuple, float] = {}
+        self._function: Callable[[], dict[tuple, float]] | None = None
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def set_function(self, function: Callable[[], dict[tuple, float]]):
+        self._function = function
+
+    def reset(self):
+        self._values.clear()
+
+    def collect(self) -> list[str]:
+        values = self._function() if self._function else self._values
+        return [f'{self.name}{format_labels(self.labels, key)} {value}' for key, value in values.items()]
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._counts: dict[tuple, list[int]] = {}
+        self._sums: dict[tuple, float] = {}
+
+    def observe(self, value: float, *labels):
+        counts = self._counts.get(labels)
+        if counts is None:
+            counts = self._counts[labels] = [0] * (len(self.buckets) + 1)
+            self._sums[labels] = 0.0
+
+        counts[bisect_left(self.buckets, value)] += 1
+        self._sums[labels] += value
+
+    @contextmanager
+    def time(self, *labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, *labels)
+
+    def count(self, *labels) -> int:
+        return sum(self._counts.get(labels, ()))
+
+    def quantile(self, q: float, *labels) -> float:
+        counts = self._counts.get(labels)
+        if not counts:
+            return 0.0
+
+        rank = q * sum(counts)
+        total, lower = 0, 0.0
+        for bound, count in zip(self.buckets, counts):
+            if count and total + count >= rank:
+                return lower + (bound - lower) * (rank - total) / count
+            total += count
+            lower = bound
+
+        return lower
+
+    def reset(self):
+        self._counts.clear()
+        self._sums.clear()
+
+    def collect(self) -> list[str]:
+        lines = []
+        for key, counts in self._counts.items():
+            total = 0
+            for bound, count in zip((*self.buckets, '+Inf'), counts):
+                total += count
+                lines.append(f'{self.name}_bucket{format_labels((*self.labels, "le"), (*key, bound))} {total}')
+            lines.append(f'{self.name}_sum{format_labels(self.labels, key)} {self._sums[key]}')
+            lines.append(f'{self.name}_count{format_labels(self.labels, key)} {total}')
+
+        return lines
+
+
+SENDS = Counter('mailing_sends_total', 'Доставки рассылок по результату', ('outcome',))
+SEND_RETRIES = Counter('mailing_send_retries_total', 'Повторные попытки отправки')
+API_LATENCY = Histogram('telegram_api_seconds', 'Время запросов к Telegram Bot API', ('method',))
+API_ERRORS = Counter('telegram_api_errors_total', 'Ошибки запросов к Telegram Bot API', ('method', 'error'))
+TICK_DURATION = Histogram('scheduler_tick_seconds', 'Длительность прохода планировщика')
+SEND_LAG = Histogram('scheduler_lag_seconds', 'Задержка между плановым и фактическим временем отправки')
+DB_QUERY = Histogram('db_query_seconds', 'Время выполнения запросов к БД')
+DB_POOL = Gauge('db_pool', 'Состояние пула соединений с БД', ('stat',))
+SENDER = Gauge('sender', 'Состояние очереди отправки', ('stat',))
+CLEANUP_DELETED = Counter('cleanup_deleted_messages_total', 'Удалённые устаревшие сообщения')
+
+
+class ApiMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request: NextRequestMiddlewareType, bot: Bot,
+                       method: TelegramMethod) -> Response:
+        api_method = method.__api_method__
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except Exception as e:
+            API_ERRORS.inc(api_method, type(e).__name__)
+            raise
+        finally:
+            API_LATENCY.observe(time.perf_counter() - started, api_method)
+
+
+def render() -> str:
+    return '\n'.join(line for metric in registry for line in metric.render()) + '\n'
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    return web.Response(body=render().encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+
+    return runner
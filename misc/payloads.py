@@ -0,0 +1,169 @@
+import json
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from aiogram import Bot
+from aiogram.enums import ParseMode
+from aiogram.types import (InlineKeyboardButton, InlineKeyboardMarkup, Message, InputMediaPhoto, InputMediaVideo,
+                           InputMediaDocument, InputMediaAnimation)
+from aiogram.utils.keyboard import InlineKeyboardBuilder
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload
+
+from config import PAYLOAD_CACHE_SIZE, MAILING_CACHE_TTL
+from db.models import Mailings
+
+MEDIA_TYPES = ('photo', 'video', 'animation', 'document')
+ALBUM_MEDIA = {'photo': InputMediaPhoto, 'video': InputMediaVideo, 'document': InputMediaDocument}
+INPUT_MEDIA = {**ALBUM_MEDIA, 'animation': InputMediaAnimation}
+
+
+class CardButton(NamedTuple):
+    text: str
+    url: str
+
+
+class MailingCard(NamedTuple):
+    id: int
+    version: int
+    text: str | None
+    media: str | None
+    media_type: str | None
+    status: bool
+    send_mode: str
+    buttons: tuple[CardButton, ...]
+
+    @classmethod
+    def from_mailing(cls, mailing: Mailings) -> 'MailingCard':
+        return cls(mailing.id, mailing.version, mailing.text, mailing.media, mailing.media_type, mailing.status,
+                   mailing.send_mode, tuple(CardButton(btn.text, btn.url) for btn in mailing.buttons))
+
+
+class MailingPayload(NamedTuple):
+    method: str
+    text: str | None
+    media: str | tuple | None
+    reply_markup: InlineKeyboardMarkup | None
+
+    async def send(self, bot: Bot, chat_id: int) -> list[Message]:
+        if self.method == 'album':
+            return await bot.send_media_group(chat_id=chat_id, media=list(self.media))
+        if self.method == 'photo':
+            msg = await bot.send_photo(chat_id=chat_id, photo=self.media, caption=self.text,
+                                       parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+        elif self.method == 'video':
+            msg = await bot.send_video(chat_id=chat_id, video=self.media, caption=self.text,
+                                       parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+        elif self.method == 'animation':
+            msg = await bot.send_animation(chat_id=chat_id, animation=self.media, caption=self.text,
+                                           parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+        elif self.method == 'document':
+            msg = await bot.send_document(chat_id=chat_id, document=self.media, caption=self.text,
+                                          parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+        else:
+            msg = await bot.send_message(chat_id=chat_id, text=self.text,
+                                         parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+
+        return [msg]
+
+    async def edit(self, bot: Bot, chat_id: int, message_id: int):
+        if self.method == 'message':
+            await bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=self.text,
+                                        parse_mode=ParseMode.HTML, reply_markup=self.reply_markup)
+        else:
+            media = INPUT_MEDIA[self.method](media=self.media, caption=self.text, parse_mode=ParseMode.HTML)
+            await bot.edit_message_media(chat_id=chat_id, message_id=message_id, media=media,
+                                         reply_markup=self.reply_markup)
+
+
+def build_reply_markup(buttons: list[tuple[str, str]]) -> InlineKeyboardMarkup | None:
+    if not buttons:
+        return None
+
+    kb = InlineKeyboardBuilder()
+    for text, url in buttons:
+        kb.add(InlineKeyboardButton(text=text, url=url))
+    kb.adjust(1)
+
+    return kb.as_markup()
+
+
+def compile_album(text: str | None, media: str) -> tuple:
+    return tuple(
+        ALBUM_MEDIA[media_type](media=file_id, caption=text if index == 0 else None,
+                                parse_mode=ParseMode.HTML if index == 0 else None)
+        for index, (media_type, file_id) in enumerate(json.loads(media))
+    )
+
+
+def compile_payload(text: str | None, media: str | None, media_type: str | None,
+                    buttons: list[tuple[str, str]]) -> MailingPayload:
+    if media and media_type == 'album':
+        return MailingPayload('album', text, compile_album(text, media), None)
+
+    if media and media_type in MEDIA_TYPES:
+        return MailingPayload(media_type, text, media, build_reply_markup(buttons))
+
+    return MailingPayload('message', text, None, build_reply_markup(buttons))
+
+
+class PayloadCache:
+    def __init__(self, size: int):
+        self.size = size
+        self._payloads: OrderedDict[tuple[int, int], MailingPayload] = OrderedDict()
+
+    def get(self, mailing: Mailings | MailingCard) -> MailingPayload:
+        key = (mailing.id, mailing.version)
+        payload = self._payloads.get(key)
+
+        if payload is None:
+            payload = compile_payload(mailing.text, mailing.media, mailing.media_type,
+                                      [(btn.text, btn.url) for btn in mailing.buttons])
+            self._payloads[key] = payload
+            while len(self._payloads) > self.size:
+                self._payloads.popitem(last=False)
+        else:
+            self._payloads.move_to_end(key)
+
+        return payload
+
+
+class MailingCache:
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self._cards: OrderedDict[int, tuple[float, MailingCard]] = OrderedDict()
+
+    async def get(self, session: AsyncSession, mailing_id: int) -> MailingCard | None:
+        cached = self._cards.get(mailing_id)
+        if cached is not None and cached[0] >= time.monotonic():
+            self._cards.move_to_end(mailing_id)
+            return cached[1]
+
+        mailing = await session.get(Mailings, mailing_id, options=[selectinload(Mailings.buttons)])
+        if mailing is None:
+            self.invalidate(mailing_id)
+            return None
+
+        card = MailingCard.from_mailing(mailing)
+        self.put(card)
+        return card
+
+    def put(self, card: MailingCard):
+        self._cards[card.id] = (time.monotonic() + self.ttl, card)
+        self._cards.move_to_end(card.id)
+        while len(self._cards) > self.size:
+            self._cards.popitem(last=False)
+
+    def refresh(self, mailing: Mailings):
+        cached = self._cards.get(mailing.id)
+        if cached is not None and cached[1].version < mailing.version:
+            self.put(MailingCard.from_mailing(mailing))
+
+    def invalidate(self, mailing_id: int):
+        self._cards.pop(mailing_id, None)
+
+
+payload_cache = PayloadCache(PAYLOAD_CACHE_SIZE)
+mailing_cache = MailingCache(PAYLOAD_CACHE_SIZE, MAILING_CACHE_TTL)
@@ -0,0 +1,379 @@
+import asyncio
+import heapq
+import os
+import socket
+import uuid
+from datetime import datetime, timedelta
+
+from aiogram import Bot
+from sqlalchemy import select, update, delete, bindparam, func, true
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import selectinload, load_only
+
+from config import MSK, SCHEDULER_RESYNC, SCHEDULER_HEARTBEAT, SCHEDULER_CLAIM_BATCH
+from db.models import Mailings, MailingTargets, SchedulerShards, session_scope, upsert
+from misc.cleanup import cleaner, record_deliveries
+from misc.logger import logger
+from misc.metrics import SENDS, TICK_DURATION, SEND_LAG
+from misc.sender import sender
+from misc.payloads import payload_cache, mailing_cache
+from misc.utils import MailingDelivery, update_schedule, next_due_time
+
+RETRY_DELAY = timedelta(minutes=1)
+OUTBOX_FLUSH_DELAY = 0.5
+
+targets_table = MailingTargets.__table__
+mailings_table = Mailings.__table__
+UPDATE_TARGETS = (update(targets_table)
+                  .where(targets_table.c.id == bindparam('row_id'))
+                  .values(last_message_id=bindparam('message_id'), extra_message_ids=bindparam('extra_ids')))
+UPDATE_MAILINGS = (update(mailings_table)
+                   .where(mailings_table.c.id == bindparam('row_id'))
+                   .values(last_sent=bindparam('sent_at')))
+
+
+def next_fire_time(mailing: Mailings) -> datetime | None:
+    if not mailing.status or not mailing.next_due_at:
+        return None
+
+    if mailing.expires_at:
+        return min(mailing.next_due_at, mailing.expires_at)
+
+    return mailing.next_due_at
+
+
+def previous_message_ids(target: MailingTargets) -> list[int]:
+    if not target.last_message_id:
+        return []
+
+    return [target.last_message_id, *(target.extra_message_ids or [])]
+
+
+class MailingScheduler:
+    def __init__(self):
+        self.process_id = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.shard: int = 0
+        self.shards: int = 1
+        self._heap: list[tuple[datetime, int]] = []
+        self._fire_times: dict[int, datetime] = {}
+        self._in_flight: set[int] = set()
+        self._deferred: set[int] = set()
+        self._jobs: set[asyncio.Task] = set()
+        self._outbox: list[tuple[int, datetime, list[dict], list[tuple]]] = []
+        self._watchers: dict[int, set[asyncio.Future]] = {}
+        self._next_resync = datetime.now(MSK)
+        self._next_heartbeat = datetime.now(MSK)
+        self._peers = 1
+        self._claim_more = False
+        self._reload = False
+        self._wakeup = asyncio.Event()
+        self._task: asyncio.Task | None = None
+
+    def schedule(self, mailing_id: int, fire_at: datetime | None):
+        if fire_at is None:
+            return self.remove(mailing_id)
+
+        self._fire_times[mailing_id] = fire_at
+        heapq.heappush(self._heap, (fire_at, mailing_id))
+
+        if self._heap[0] == (fire_at, mailing_id):
+            self._wakeup.set()
+
+    def remove(self, mailing_id: int):
+        self._fire_times.pop(mailing_id, None)
+
+    def notify(self, mailing: Mailings):
+        self.schedule(mailing.id, next_fire_time(mailing))
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def watch(self, mailing_id: int) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._watchers.setdefault(mailing_id, set()).add(future)
+        future.add_done_callback(lambda done: self._unwatch(mailing_id, done))
+        return future
+
+    def _unwatch(self, mailing_id: int, future: asyncio.Future):
+        watchers = self._watchers.get(mailing_id)
+        if watchers is not None:
+            watchers.discard(future)
+            if not watchers:
+                del self._watchers[mailing_id]
+
+    def _is_actual(self, fire_at: datetime, mailing_id: int) -> bool:
+        return self._fire_times.get(mailing_id) == fire_at
+
+    def _pop_due(self, now: datetime) -> list[int]:
+        due_ids = []
+        while self._heap and self._heap[0][0] <= now:
+            fire_at, mailing_id = heapq.heappop(self._heap)
+            if self._is_actual(fire_at, mailing_id):
+                del self._fire_times[mailing_id]
+                if mailing_id in self._in_flight:
+                    self._deferred.add(mailing_id)
+                else:
+                    due_ids.append(mailing_id)
+
+        return due_ids
+
+    def _seconds_to_next(self, now: datetime) -> float | None:
+        while self._heap and not self._is_actual(*self._heap[0]):
+            heapq.heappop(self._heap)
+
+        if not self._heap:
+            return None
+
+        return max((self._heap[0][0] - now).total_seconds(), 0)
+
+    def _resync_enabled(self) -> bool:
+        return bool(SCHEDULER_RESYNC) and (self.shards > 1 or self._peers > 1)
+
+    def _resync_due(self, now: datetime) -> bool:
+        if not self._resync_enabled() or now < self._next_resync:
+            return False
+
+        self._next_resync = now + timedelta(seconds=SCHEDULER_RESYNC)
+        return True
+
+    def _heartbeat_due(self, now: datetime) -> bool:
+        if not SCHEDULER_HEARTBEAT or now < self._next_heartbeat:
+            return False
+
+        self._next_heartbeat = now + timedelta(seconds=SCHEDULER_HEARTBEAT)
+        return True
+
+    def _timeout(self, now: datetime) -> float | None:
+        if self._claim_more:
+            return 0
+
+        deadlines = [self._seconds_to_next(now)]
+        if self._resync_enabled():
+            deadlines.append((self._next_resync - now).total_seconds())
+        if SCHEDULER_HEARTBEAT:
+            deadlines.append((self._next_heartbeat - now).total_seconds())
+        if self._outbox:
+            deadlines.append(RETRY_DELAY.total_seconds())
+
+        deadlines = [seconds for seconds in deadlines if seconds is not None]
+        return max(min(deadlines), 0) if deadlines else None
+
+    def _in_shard(self):
+        if self.shards == 1:
+            return true()
+        return Mailings.id % self.shards == self.shard
+
+    async def _heartbeat(self, session: AsyncSession, now: datetime):
+        stmt = upsert(SchedulerShards).values(process_id=self.process_id, shard=self.shard, shards=self.shards,
+                                              heartbeat_at=now)
+        await session.execute(stmt.on_conflict_do_update(
+            index_elements=[SchedulerShards.process_id],
+            set_={'heartbeat_at': now}
+        ))
+
+        threshold = now - timedelta(seconds=SCHEDULER_HEARTBEAT * 3)
+        await session.execute(delete(SchedulerShards).where(SchedulerShards.heartbeat_at < threshold))
+        alive = await session.scalar(
+            select(func.count()).select_from(SchedulerShards).where(SchedulerShards.heartbeat_at >= threshold)
+        )
+        if alive < self._peers:
+            self._reload = True
+        self._peers = alive
+        sender.set_share(alive)
+
+    async def _load(self, session: AsyncSession):
+        mailings = (await session.execute(
+            select(Mailings)
+            .where(Mailings.status == True, self._in_shard())
+            .options(load_only(Mailings.id, Mailings.per, Mailings.globalper, Mailings.status, Mailings.created_at,
+                               Mailings.last_sent, Mailings.expires_at, Mailings.next_due_at, Mailings.quiet_hours))
+        )).scalars().all()
+
+        for mailing in mailings:
+            if mailing.next_due_at is None:
+                update_schedule(mailing)
+        await session.commit()
+
+        for mailing in mailings:
+            self.notify(mailing)
+
+    async def _flush_outbox(self, session: AsyncSession, results: list):
+        mailing_rows = [{'row_id': mailing_id, 'sent_at': sent_at} for mailing_id, sent_at, _, _ in results]
+        target_rows = [row for _, _, rows, _ in results for row in rows]
+
+        if target_rows:
+            await session.execute(UPDATE_TARGETS, target_rows)
+        if mailing_rows:
+            await session.execute(UPDATE_MAILINGS, mailing_rows)
+
+        await record_deliveries(session, [(mailing_id, sent_at, messages)
+                                          for mailing_id, sent_at, _, messages in results])
+
+    async def _claim_due(self, session: AsyncSession, now: datetime) -> list[tuple[Mailings, datetime]]:
+        expired_ids = (await session.execute(
+            update(Mailings)
+            .where(Mailings.status == True, Mailings.expires_at <= now, self._in_shard())
+            .values(status=False)
+            .returning(Mailings.id)
+        )).scalars().all()
+        for mailing_id in expired_ids:
+            self.remove(mailing_id)
+            mailing_cache.invalidate(mailing_id)
+
+        mailings = (await session.execute(
+            select(Mailings)
+            .where(Mailings.status == True, Mailings.next_due_at <= now, self._in_shard(),
+                   Mailings.id.not_in(list(self._in_flight)))
+            .order_by(Mailings.next_due_at)
+            .limit(SCHEDULER_CLAIM_BATCH)
+            .with_for_update(skip_locked=True, of=Mailings)
+            .options(selectinload(Mailings.buttons), selectinload(Mailings.targets))
+        )).scalars().all()
+
+        claimed = []
+        for mailing in mailings:
+            if mailing.targets:
+                claimed.append((mailing, mailing.next_due_at))
+            mailing.next_due_at = next_due_time(mailing, now)
+            self.notify(mailing)
+
+        self._claim_more = len(mailings) == SCHEDULER_CLAIM_BATCH
+
+        return claimed
+
+    async def _tick(self, bot: Bot, session: AsyncSession, now: datetime, fire: bool, heartbeat: bool):
+        results, self._outbox = self._outbox, []
+        try:
+            if heartbeat:
+                await self._heartbeat(session, now)
+            await self._flush_outbox(session, results)
+            mailings = await self._claim_due(session, now) if fire else []
+            await session.commit()
+        except Exception:
+            self._outbox = results + self._outbox
+            raise
+
+        for mailing, due_at in mailings:
+            self._dispatch(bot, mailing, due_at)
+
+    def _dispatch(self, bot: Bot, mailing: Mailings, due_at: datetime):
+        mailing_cache.refresh(mailing)
+        payload = payload_cache.get(mailing)
+        jobs = []
+        for target in mailing.targets:
+            previous_ids = previous_message_ids(target)
+            future = sender.submit(target.chat_id, MailingDelivery(
+                bot, target.chat_id, previous_ids, mailing.id, payload, mailing.send_mode
+            ))
+            jobs.append((target.id, target.chat_id, previous_ids, future))
+
+        self._in_flight.add(mailing.id)
+        task = asyncio.create_task(self._complete(mailing.id, due_at, jobs))
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+
+    async def _complete(self, mailing_id: int, due_at: datetime, jobs: list[tuple[int, int, list[int], asyncio.Future]]):
+        try:
+            results = await asyncio.gather(*(future for *_, future in jobs), return_exceptions=True)
+            SEND_LAG.observe((datetime.now(MSK) - due_at).total_seconds())
+
+            delivered, messages = [], []
+            for (target_id, chat_id, previous_ids, _), result in zip(jobs, results):
+                if isinstance(result, Exception):
+                    SENDS.inc('failed')
+                    logger.warning('Ошибка при отправке рассылки',
+                                   extra={'mailing_id': mailing_id, 'chat_id': chat_id, 'error': str(result)})
+                elif result:
+                    message_ids, stale_ids = result
+                    delivered.append({'row_id': target_id, 'message_id': message_ids[0],
+                                      'extra_ids': message_ids[1:] or None})
+                    messages.append((chat_id, previous_ids, message_ids, stale_ids))
+
+            for watcher in self._watchers.pop(mailing_id, set()):
+                if not watcher.done():
+                    watcher.set_result((len(delivered), len(jobs)))
+
+            if delivered:
+                if not self._outbox:
+                    asyncio.get_running_loop().call_later(OUTBOX_FLUSH_DELAY, self._wakeup.set)
+                self._outbox.append((mailing_id, datetime.now(MSK), delivered, messages))
+        finally:
+            self._in_flight.discard(mailing_id)
+            if mailing_id in self._deferred:
+                self._deferred.discard(mailing_id)
+                self.schedule(mailing_id, datetime.now(MSK))
+
+    async def run(self, bot: Bot):
+        while True:
+            try:
+                async with session_scope() as session:
+                    await self._load(session)
+                break
+            except Exception as e:
+                logger.warning('Не удалось загрузить рассылки', extra={'error': str(e)})
+                await asyncio.sleep(RETRY_DELAY.total_seconds())
+
+        while True:
+            now = datetime.now(MSK)
+            due_ids = self._pop_due(now)
+            fire = bool(due_ids) or self._resync_due(now) or self._claim_more
+            heartbeat = self._heartbeat_due(now)
+
+            if fire or heartbeat or self._outbox:
+                try:
+                    with TICK_DURATION.time():
+                        async with session_scope() as session:
+                            await self._tick(bot, session, now, fire, heartbeat)
+                except Exception:
+                    logger.exception('Ошибка в рассылке', extra={'due': len(due_ids)})
+                    self._claim_more = False
+                    for mailing_id in due_ids:
+                        self.schedule(mailing_id, datetime.now(MSK) + RETRY_DELAY)
+
+            if self._reload:
+                try:
+                    async with session_scope() as session:
+                        await self._load(session)
+                    self._reload = False
+                except Exception as e:
+                    logger.warning('Не удалось загрузить рассылки', extra={'error': str(e)})
+
+            self._wakeup.clear()
+            timeout = self._timeout(datetime.now(MSK))
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, bot: Bot, shard: int = 0, shards: int = 1):
+        self.shard, self.shards = shard, shards
+        sender.start()
+        cleaner.start(bot, shard, shards)
+        self._task = asyncio.create_task(self.run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+        if self._outbox:
+            results, self._outbox = self._outbox, []
+            try:
+                async with session_scope() as session:
+                    await self._flush_outbox(session, results)
+                    await session.commit()
+            except Exception as e:
+                logger.warning('Не удалось сохранить отправленные сообщения', extra={'error': str(e)})
+
+        await cleaner.stop()
+        await sender.stop()
+
+
+scheduler = MailingScheduler()
+
+
+async def start_mailing_scheduler(bot: Bot, shard: int = 0, shards: int = 1):
+    scheduler.start(bot, shard, shards)
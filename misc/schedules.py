@@ -0,0 +1,184 @@
+import re
+from bisect import bisect_left
+from datetime import date, datetime, time, timedelta
+from functools import lru_cache
+from typing import NamedTuple
+
+from config import MSK
+
+PERIOD_UNITS = {'m': 60, 'h': 3600, 'd': 86400, 'w': 7 * 86400, 'M': 30 * 86400}
+PERIOD_PART_REGEX = re.compile(r'(\d+)([Mwdhm])')
+INTERVAL_REGEX = re.compile(r'^(\d+[Mwdhm]\s*)+$')
+QUIET_WINDOW_REGEX = re.compile(r'^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})$')
+MIN_PERIOD = 60
+CRON_FIELDS = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 7))
+CRON_SEARCH_DAYS = 5 * 366
+
+
+class ScheduleError(ValueError):
+    pass
+
+
+def parse_period(time_str: str | None) -> int | None:
+    if not time_str:
+        return None
+
+    return sum(int(value) * PERIOD_UNITS[unit] for value, unit in PERIOD_PART_REGEX.findall(time_str))
+
+
+def is_cron(value: str | None) -> bool:
+    return bool(value) and not INTERVAL_REGEX.match(value.strip()) and len(value.split()) == 5
+
+
+def parse_cron_field(field: str, low: int, high: int) -> tuple[int, ...]:
+    values = set()
+    for part in field.split(','):
+        part, _, step = part.partition('/')
+        if part == '*':
+            start, end = low, high
+        elif '-' in part:
+            start, end = map(int, part.split('-', 1))
+        else:
+            start = int(part)
+            end = high if step else start
+
+        step = int(step) if step else 1
+        if not low <= start <= end <= high or step < 1:
+            raise ScheduleError(f'Недопустимое значение поля cron: {field}')
+
+        values.update(range(start, end + 1, step))
+
+    return tuple(sorted(values))
+
+
+class CronSchedule:
+    def __init__(self, expression: str):
+        fields = expression.split()
+        if len(fields) != 5:
+            raise ScheduleError('Cron-выражение должно состоять из 5 полей')
+
+        try:
+            minutes, hours, days, months, weekdays = (
+                parse_cron_field(field, low, high) for field, (low, high) in zip(fields, CRON_FIELDS)
+            )
+        except ValueError as e:
+            raise ScheduleError(f'Неверное cron-выражение: {expression}') from e
+
+        self.minutes = minutes
+        self.hours = hours
+        self.days = set(days)
+        self.months = set(months)
+        self.weekdays = {day % 7 for day in weekdays}
+        self.any_day = fields[2].startswith('*') or fields[4].startswith('*')
+
+    def _day_matches(self, day: date) -> bool:
+        if day.month not in self.months:
+            return False
+
+        in_days = day.day in self.days
+        in_weekdays = day.isoweekday() % 7 in self.weekdays
+        return in_days and in_weekdays if self.any_day else in_days or in_weekdays
+
+    def _first_time(self, hour: int, minute: int) -> time | None:
+        index = bisect_left(self.hours, hour)
+        if index == len(self.hours):
+            return None
+
+        if self.hours[index] == hour:
+            minute_index = bisect_left(self.minutes, minute)
+            if minute_index < len(self.minutes):
+                return time(hour, self.minutes[minute_index])
+            if index + 1 == len(self.hours):
+                return None
+            index += 1
+
+        return time(self.hours[index], self.minutes[0])
+
+    def next_after(self, after: datetime) -> datetime | None:
+        start = after.astimezone(MSK).replace(second=0, microsecond=0) + timedelta(minutes=1)
+        day, hour, minute = start.date(), start.hour, start.minute
+
+        for _ in range(CRON_SEARCH_DAYS):
+            if self._day_matches(day):
+                fire_at = self._first_time(hour, minute)
+                if fire_at is not None:
+                    return MSK.localize(datetime.combine(day, fire_at))
+
+            day += timedelta(days=1)
+            hour = minute = 0
+
+        return None
+
+
+class QuietHours:
+    def __init__(self, windows: str):
+        self.windows: list[tuple[int, int]] = []
+        for part in windows.split(','):
+            match = QUIET_WINDOW_REGEX.match(part.strip())
+            if not match:
+                raise ScheduleError(f'Неверный формат тихих часов: {part}')
+
+            start_hour, start_minute, end_hour, end_minute = map(int, match.groups())
+            if start_hour > 23 or end_hour > 23 or start_minute > 59 or end_minute > 59:
+                raise ScheduleError(f'Неверное время в тихих часах: {part}')
+
+            start, end = start_hour * 60 + start_minute, end_hour * 60 + end_minute
+            if start == end:
+                raise ScheduleError(f'Пустое окно тихих часов: {part}')
+
+            self.windows.append((start, end))
+
+    def _window_end(self, moment: datetime) -> datetime | None:
+        minute = moment.hour * 60 + moment.minute
+        for start, end in self.windows:
+            if start < end and start <= minute < end or start > end and minute < end:
+                day = moment.date()
+            elif start > end and minute >= start:
+                day = moment.date() + timedelta(days=1)
+            else:
+                continue
+
+            return MSK.localize(datetime.combine(day, time(end // 60, end % 60)))
+
+        return None
+
+    def release(self, moment: datetime) -> datetime:
+        moment = moment.astimezone(MSK)
+        for _ in range(len(self.windows) + 1):
+            window_end = self._window_end(moment)
+            if window_end is None:
+                break
+            moment = window_end
+
+        return moment
+
+
+class Schedule(NamedTuple):
+    period: timedelta | None
+    cron: CronSchedule | None
+    quiet: QuietHours | None
+
+    def next_fire(self, now: datetime, anchor: datetime | None = None, catch_up: bool = False) -> datetime | None:
+        if self.cron:
+            due = self.cron.next_after(now)
+        elif self.period:
+            due = anchor + self.period if anchor else now
+            if anchor is None or catch_up and due <= now:
+                due = now
+            elif due <= now:
+                due += self.period * ((now - due) // self.period + 1)
+        else:
+            return None
+
+        return self.quiet.release(due) if self.quiet and due else due
+
+
+@lru_cache(maxsize=1024)
+def compile_schedule(per: str | None, quiet_hours: str | None = None) -> Schedule:
+    quiet = QuietHours(quiet_hours) if quiet_hours else None
+
+    if is_cron(per):
+        return Schedule(None, CronSchedule(per), quiet)
+
+    seconds = parse_period(per)
+    return Schedule(timedelta(seconds=max(seconds, MIN_PERIOD)) if seconds else None, None, quiet)
@@ -0,0 +1,180 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable
+
+from aiogram.exceptions import TelegramRetryAfter, TelegramNetworkError, TelegramServerError
+
+from config import SEND_WORKERS, GLOBAL_RATE_LIMIT, CHAT_RATE_LIMIT, CHAT_RATE_PERIOD, SEND_MAX_ATTEMPTS
+from misc.logger import logger
+from misc.metrics import SEND_RETRIES, SENDER
+
+STATS_WINDOW = 10
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+
+RETRYABLE_ERRORS = (TelegramRetryAfter, TelegramNetworkError, TelegramServerError)
+
+
+def retry_delay(error: Exception, attempt: int) -> float:
+    if isinstance(error, TelegramRetryAfter):
+        return error.retry_after + random.uniform(0, 1 + error.retry_after * 0.1)
+
+    return min(BACKOFF_BASE * 2 ** attempt, BACKOFF_MAX) * random.uniform(0.5, 1.5)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float = 1):
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def try_acquire(self) -> float:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return 0
+
+        return (1 - self._tokens) / self.rate
+
+    async def acquire(self):
+        async with self._lock:
+            while delay := self.try_acquire():
+                await asyncio.sleep(delay)
+
+    def pause(self, seconds: float):
+        self._tokens = min(self._tokens, 0)
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+
+class SendEngine:
+    def __init__(self, workers: int, global_rate: float, chat_rate: float, max_attempts: int):
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.base_global_rate = global_rate
+        self.base_chat_rate = chat_rate
+        self.chat_rate = chat_rate
+        self._global_bucket = TokenBucket(global_rate)
+        self._chat_buckets: dict[int, TokenBucket] = {}
+        self._pending: dict[int, deque[tuple]] = {}
+        self._ready: asyncio.Queue[int] = asyncio.Queue()
+        self._tasks: list[asyncio.Task] = []
+        self._sent: deque[float] = deque()
+        self._in_progress = 0
+        self._retry_pending = 0
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.chat_rate)
+
+        return bucket
+
+    def set_share(self, processes: int):
+        processes = max(processes, 1)
+        self.chat_rate = self.base_chat_rate / processes
+        self._global_bucket.rate = self.base_global_rate / processes
+        for bucket in self._chat_buckets.values():
+            bucket.rate = self.chat_rate
+
+    def _enqueue(self, chat_id: int, job: tuple):
+        pending = self._pending.get(chat_id)
+        if pending is None:
+            self._pending[chat_id] = deque([job])
+            self._ready.put_nowait(chat_id)
+        else:
+            pending.append(job)
+
+    def submit(self, chat_id: int, send: Callable[[], Awaitable[Any]]) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        self._enqueue(chat_id, (send, future, 1))
+        return future
+
+    def _requeue(self, chat_id: int, job: tuple):
+        self._retry_pending -= 1
+        self._enqueue(chat_id, job)
+
+    def _release(self, chat_id: int):
+        if self._pending[chat_id]:
+            self._ready.put_nowait(chat_id)
+        else:
+            del self._pending[chat_id]
+
+    def _retry(self, chat_id: int, send: Callable, future: asyncio.Future, attempt: int, error: Exception):
+        delay = retry_delay(error, attempt)
+        if isinstance(error, TelegramRetryAfter):
+            self._chat_bucket(chat_id).pause(delay)
+
+        SEND_RETRIES.inc()
+        logger.warning('Повторная отправка', extra={'chat_id': chat_id, 'delay': round(delay, 1),
+                                                    'attempt': attempt + 1, 'error': str(error)})
+        self._retry_pending += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, chat_id, (send, future, attempt + 1))
+
+    async def _worker(self):
+        while True:
+            chat_id = await self._ready.get()
+            delay = self._chat_bucket(chat_id).try_acquire()
+            if delay:
+                asyncio.get_running_loop().call_later(delay, self._ready.put_nowait, chat_id)
+                continue
+
+            send, future, attempt = self._pending[chat_id].popleft()
+            self._in_progress += 1
+            try:
+                await self._global_bucket.acquire()
+                result = await send()
+                self._sent.append(time.monotonic())
+                if not future.done():
+                    future.set_result(result)
+            except RETRYABLE_ERRORS as e:
+                if attempt < self.max_attempts:
+                    self._retry(chat_id, send, future, attempt, e)
+                elif not future.done():
+                    future.set_exception(e)
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            finally:
+                self._in_progress -= 1
+                self._release(chat_id)
+
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(pending) for pending in self._pending.values())
+
+    @property
+    def sends_per_second(self) -> float:
+        threshold = time.monotonic() - STATS_WINDOW
+        while self._sent and self._sent[0] < threshold:
+            self._sent.popleft()
+
+        return len(self._sent) / STATS_WINDOW
+
+    def stats(self) -> dict:
+        return {
+            'sends_per_second': self.sends_per_second,
+            'queue_depth': self.queue_depth,
+            'in_progress': self._in_progress,
+            'retry_pending': self._retry_pending,
+        }
+
+
+sender = SendEngine(SEND_WORKERS, GLOBAL_RATE_LIMIT, CHAT_RATE_LIMIT / CHAT_RATE_PERIOD, SEND_MAX_ATTEMPTS)
+SENDER.set_function(lambda: {(key,): value for key, value in sender.stats().items()})
@@ -1,35 +1,72 @@
-import asyncio
 from datetime import datetime, timedelta
 
 from aiogram import Bot
-from aiogram.enums import ParseMode
-from aiogram.types import InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.fsm.context import FSMContext
+from aiogram.types import InlineKeyboardButton, Message
 from aiogram.utils.keyboard import InlineKeyboardBuilder
-from sqlalchemy import select
+from sqlalchemy import select, update, delete, insert, bindparam, func
 from sqlalchemy.ext.asyncio import AsyncSession
-from sqlalchemy.orm import selectinload
 
 from config import MSK
-from db.models import Mailings
-
-
-async def get_mailings_with_buttons(session: AsyncSession):
-    result = (await session.execute(
-        select(Mailings)
-        .options(selectinload(Mailings.buttons))
-    )).scalars().all()
+from db.models import Mailings, Buttons
+from misc.logger import logger
+from misc.metrics import SENDS
+from misc.payloads import MailingPayload
+from misc.schedules import Schedule, ScheduleError, compile_schedule, parse_period
+from misc.sender import RETRYABLE_ERRORS
+
+MENU_PAGE_SIZE = 10
+MAX_ALBUM_SIZE = 10
+SEND_MODES = {
+    'replace': '🗑 Удалить и отправить',
+    'edit': '✏️ Редактировать',
+    'send_then_delete': '📨 Отправить и удалить',
+}
+
+
+async def get_mailings_with_buttons(session: AsyncSession, after_id: int | None = None,
+                                    before_id: int | None = None):
+    query = select(Mailings.id, func.substr(Mailings.text, 1, 20).label('title'), Mailings.status)
+
+    if before_id is not None:
+        query = query.where(Mailings.id < before_id).order_by(Mailings.id.desc())
+    else:
+        if after_id is not None:
+            query = query.where(Mailings.id > after_id)
+        query = query.order_by(Mailings.id)
+
+    result = (await session.execute(query.limit(MENU_PAGE_SIZE + 1))).all()
+    if not result and (after_id is not None or before_id is not None):
+        return await get_mailings_with_buttons(session)
+
+    has_more = len(result) > MENU_PAGE_SIZE
+    result = result[:MENU_PAGE_SIZE]
+    if before_id is not None:
+        result.reverse()
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = after_id is not None, has_more
 
     builder = InlineKeyboardBuilder()
 
     if result:
         for mailing in result:
-            text = (mailing.text[:20] + "...") if mailing.text else "Рассылка без текста"
+            text = (mailing.title + "...") if mailing.title else "Рассылка без текста"
             builder.add(InlineKeyboardButton(
-                text=text,
+                text=f"{'🟢' if mailing.status else '🔴'} {text}",
                 callback_data=f"mailing_{mailing.id}"
             ))
         builder.adjust(1)
 
+        pagination = []
+        if has_prev:
+            pagination.append(InlineKeyboardButton(text="⬅️", callback_data=f"mailings_before_{result[0].id}"))
+        if has_next:
+            pagination.append(InlineKeyboardButton(text="➡️", callback_data=f"mailings_after_{result[-1].id}"))
+        if pagination:
+            builder.row(*pagination)
+
     builder.row(InlineKeyboardButton(
         text="➕ Создать рассылку",
         callback_data="create_mailing"
@@ -38,136 +75,154 @@ async def get_mailings_with_buttons(session: AsyncSession):
     return builder
 
 
-async def mailing_scheduler(bot: Bot, session: AsyncSession, chat_id: int):
-    while True:
-        try:
-            mailings = (await session.execute(select(Mailings)
-                                            .where(Mailings.status == True)
-                                            .options(selectinload(Mailings.buttons)))).scalars().all()
-
-            for mailing in mailings:
-                if not await check_global_period(mailing.globalper, mailing.created_at):
-                    mailing.status = False
-                    await session.commit()
-                    continue
+def mailing_schedule(mailing: Mailings) -> Schedule | None:
+    try:
+        return compile_schedule(mailing.per, mailing.quiet_hours)
+    except ScheduleError as e:
+        logger.warning('Неверное расписание рассылки', extra={'mailing_id': mailing.id, 'error': str(e)})
+        return None
 
-                if not await check_periodicity(mailing.per, mailing.last_sent):
-                    continue
+def update_schedule(mailing: Mailings):
+    now = datetime.now(MSK)
+    mailing.created_at = mailing.created_at or now
 
-                if mailing.last_message_id:
-                    try:
-                        await bot.delete_message(chat_id=chat_id, message_id=mailing.last_message_id)
-                    except Exception as e:
-                        print(f'Не удалось удалить предыдущее сообщение: {e}')
+    globalper_seconds = parse_period(mailing.globalper)
+    mailing.expires_at = mailing.created_at + timedelta(seconds=globalper_seconds) if globalper_seconds else None
 
-                message_id = await send_mailing(bot, chat_id, mailing)
+    schedule = mailing_schedule(mailing)
+    mailing.next_due_at = schedule.next_fire(now, mailing.last_sent, catch_up=True) if schedule else None
 
-                mailing.last_sent = datetime.now(MSK)
-                mailing.last_message_id = message_id
-                await session.commit()
+def next_due_time(mailing: Mailings, now: datetime) -> datetime | None:
+    schedule = mailing_schedule(mailing)
+    return schedule.next_fire(now, mailing.next_due_at) if schedule else None
 
-        except Exception as e:
-            print(f'Ошибка в рассылке: {e}')
+def extract_media(message: Message) -> tuple[str, str] | None:
+    if message.photo:
+        return 'photo', message.photo[-1].file_id
+    if message.video:
+        return 'video', message.video.file_id
+    if message.animation:
+        return 'animation', message.animation.file_id
+    if message.document:
+        return 'document', message.document.file_id
 
-        await asyncio.sleep(60)
+    return None
 
-async def parse_time(time_str: str) -> dict:
-    time_dict = {'d': 0, 'h': 0, 'm': 0, 'w': 0, 'M': 0}
+async def collect_album(message: Message, state: FSMContext, media: tuple[str, str]) -> bool:
+    data = await state.get_data()
 
-    parts = time_str.split()
-    for part in parts:
-        if part[-1] in time_dict:
-            try:
-                time_dict[part[-1]] = int(part[:-1])
-            except ValueError:
-                continue
+    album = data.get('album', []) if data.get('album_id') == message.media_group_id else []
+    album.append(list(media))
+    await state.update_data(album_id=message.media_group_id, album=album[:MAX_ALBUM_SIZE])
 
-    return time_dict
+    return len(album) == 1
 
-async def check_global_period(globalper: str, created_at: datetime) -> bool | None:
-    if not globalper:
+async def delete_previous(bot: Bot, chat_id: int, previous_ids: list[int]) -> bool:
+    if not previous_ids:
         return True
 
-    time_dict = await parse_time(globalper)
-
-    total_days = (time_dict['d'] + time_dict['w'] * 7 + time_dict['M'] * 30)
-
-    delta = timedelta(days=total_days,
-                      hours=time_dict['h'],
-                      minutes=time_dict['m'])
-
-    return datetime.now(MSK) < created_at + delta
-
-async def check_periodicity(per: str, last_sent: datetime) -> bool:
-    if not per:
+    try:
+        if len(previous_ids) == 1:
+            await bot.delete_message(chat_id=chat_id, message_id=previous_ids[0])
+        else:
+            await bot.delete_messages(chat_id=chat_id, message_ids=previous_ids)
+        return True
+    except RETRYABLE_ERRORS:
+        raise
+    except Exception as e:
+        logger.warning('Не удалось удалить предыдущее сообщение', extra={'chat_id': chat_id, 'error': str(e)})
         return False
 
-    if not last_sent:
+async def edit_mailing(bot: Bot, chat_id: int, message_id: int, mailing_id: int, payload: MailingPayload) -> bool:
+    try:
+        await payload.edit(bot, chat_id, message_id)
+        SENDS.inc('edited')
         return True
 
-    time_dict = await parse_time(per)
-
-    delta = timedelta(days=time_dict['d'],
-                      hours=time_dict['h'],
-                      minutes=time_dict['m'])
-
-    return datetime.now(MSK) >= last_sent + delta
-
-async def send_mailing(bot: Bot, chat_id: int, mailing: Mailings) -> int | None:
-    reply_markup = None
-    if mailing.buttons:
-        kb = InlineKeyboardBuilder()
-        for btn in mailing.buttons:
-            kb.add(InlineKeyboardButton(text=btn.text, url=btn.url))
-        kb.adjust(1)
-        reply_markup = kb.as_markup()
-
+    except RETRYABLE_ERRORS:
+        raise
+    except TelegramBadRequest as e:
+        if 'message is not modified' in e.message:
+            SENDS.inc('unchanged')
+            return True
+        logger.warning('Не удалось отредактировать рассылку',
+                       extra={'mailing_id': mailing_id, 'chat_id': chat_id, 'error': str(e)})
+    except Exception as e:
+        logger.warning('Не удалось отредактировать рассылку',
+                       extra={'mailing_id': mailing_id, 'chat_id': chat_id, 'error': str(e)})
+
+    return False
+
+class MailingDelivery:
+    def __init__(self, bot: Bot, chat_id: int, previous_ids: list[int], mailing_id: int,
+                 payload: MailingPayload, send_mode: str = 'replace'):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.previous_ids = previous_ids
+        self.mailing_id = mailing_id
+        self.payload = payload
+        self.send_mode = send_mode
+        self.try_edit = send_mode == 'edit' and len(previous_ids) == 1 and payload.method != 'album'
+        self.to_delete = [] if send_mode == 'send_then_delete' else list(previous_ids)
+        self.stale_ids: list[int] = []
+
+    async def __call__(self) -> tuple[list[int], list[int]] | None:
+        if self.try_edit:
+            if await edit_mailing(self.bot, self.chat_id, self.previous_ids[0], self.mailing_id, self.payload):
+                return self.previous_ids, []
+            self.try_edit = False
+
+        if self.send_mode == 'send_then_delete':
+            message_ids = await send_mailing(self.bot, self.chat_id, self.mailing_id, self.payload)
+            return (message_ids, self.previous_ids) if message_ids else None
+
+        if self.to_delete:
+            if not await delete_previous(self.bot, self.chat_id, self.to_delete):
+                self.stale_ids = self.to_delete
+            self.to_delete = []
+
+        message_ids = await send_mailing(self.bot, self.chat_id, self.mailing_id, self.payload)
+        return (message_ids, self.stale_ids) if message_ids else None
+
+async def send_mailing(bot: Bot, chat_id: int, mailing_id: int, payload: MailingPayload) -> list[int] | None:
     try:
-        if mailing.media:
-            if mailing.media.startswith('AgAC'):
-                msg = await bot.send_photo(
-                    chat_id=chat_id,
-                    photo=mailing.media,
-                    caption=mailing.text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            elif mailing.media.startswith('BAAC'):
-                msg = await bot.send_video(
-                    chat_id=chat_id,
-                    video=mailing.media,
-                    caption=mailing.text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            elif mailing.media.startswith('CgAC'):
-                msg = await bot.send_animation(
-                    chat_id=chat_id,
-                    animation=mailing.media,
-                    caption=mailing.text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-            else:
-                msg = await bot.send_message(
-                    chat_id=chat_id,
-                    text=mailing.text,
-                    parse_mode=ParseMode.HTML,
-                    reply_markup=reply_markup
-                )
-        else:
-            msg = await bot.send_message(
-                chat_id=chat_id,
-                text=mailing.text,
-                parse_mode=ParseMode.HTML,
-                reply_markup=reply_markup
-            )
-
-        return msg.message_id
+        message_ids = [msg.message_id for msg in await payload.send(bot, chat_id)]
+        SENDS.inc('sent')
+        return message_ids
 
+    except RETRYABLE_ERRORS:
+        raise
     except Exception as e:
-        print(f'Ошибка при отправке рассылки {mailing.id}: {e}')
+        SENDS.inc('failed')
+        logger.warning('Ошибка при отправке рассылки',
+                       extra={'mailing_id': mailing_id, 'chat_id': chat_id, 'error': str(e)})
         return None
 
-async def start_mailing_scheduler(bot: Bot, session: AsyncSession, chat_id: int):
-    asyncio.create_task(mailing_scheduler(bot, session, chat_id))
\ No newline at end of file
+buttons_table = Buttons.__table__
+UPDATE_BUTTONS = (update(buttons_table)
+                  .where(buttons_table.c.id == bindparam('row_id'))
+                  .values(text=bindparam('new_text'), url=bindparam('new_url')))
+
+
+async def replace_buttons(session: AsyncSession, mailing_id: int, buttons: list[tuple[str, str]]):
+    existing = (await session.execute(
+        select(Buttons.id, Buttons.text, Buttons.url).where(Buttons.mailing_id == mailing_id).order_by(Buttons.id)
+    )).all()
+
+    changed = [
+        {'row_id': row.id, 'new_text': text, 'new_url': url}
+        for row, (text, url) in zip(existing, buttons)
+        if (row.text, row.url) != (text, url)
+    ]
+    removed = [row.id for row in existing[len(buttons):]]
+    added = [{'mailing_id': mailing_id, 'text': text, 'url': url} for text, url in buttons[len(existing):]]
+
+    if changed:
+        await session.execute(UPDATE_BUTTONS, changed)
+    if removed:
+        await session.execute(delete(Buttons).where(Buttons.id.in_(removed)))
+    if added:
+        await session.execute(insert(Buttons), added)
+
+async def bump_version(session: AsyncSession, mailing_id: int):
+    await session.execute(update(Mailings).where(Mailings.id == mailing_id).values(version=Mailings.version + 1))